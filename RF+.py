@@ -21,65 +21,553 @@
 
 import argparse
 from ete3 import Tree
+from ete3.coretype.tree import TreeError
 import math
+import numpy as np
 import itertools
+import re
 import csv
+import json
 import time
+import gzip
+import bz2
+import lzma
+import sys
+import functools
+import collections
+import contextlib
+import cProfile
+import tracemalloc
+import os
+import hashlib
+import mmap
+import stat
+import socketserver
+import signal
+import threading
+import asyncio
+import io
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+
+# Color codes of the nodes in compareTree. NONE is the color stored for index -1, so that looking up the color of a
+# missing child or of the parent of the root never matches a real color
+GREEN, RED, BLUE, YELLOW, NONE = 0, 1, 2, 3, 4
+
+# Leaf names written by CompactTree.writeNewick have the characters that ete3 does not allow in newick names replaced
+# by "_", as in ete3's write(format = 9), and the text is written to the stream every NEWICK_CHUNK pieces
+NEWICK_ESCAPE = str.maketrans({c: "_" for c in ":;(),[]\t\n\r="})
+NEWICK_CHUNK = 1 << 16
+
+
+
+class Profile:
+    # Instrumentation of the --profile option of main(): wall clock time spent in every phase (perf_counter_ns
+    # nanoseconds, not counting the time spent in the phases nested in it) and counters of the work done, and with
+    # --profile-memory the peak memory traced by tracemalloc (peak, None when memory is not traced) and the peak memory
+    # traced during every phase, nested phases included (peaks)
+    # Phases may be recorded by several threads (see comparePipeline): every thread has its own stack of nested phases,
+    # each entry holding the time spent in the phases nested in it and the highest peak seen so far during the phase.
+    # The traced peak is reset when a phase starts, after being added to the peaks of the phases around it (and to top,
+    # the highest peak seen outside of the resets). tracemalloc has a single peak for all threads, so the peaks of
+    # phases running at the same time in different threads are only approximate
+    def __init__(self):
+        self.times, self.counts, self.nested = {}, {}, {}
+        self.peak, self.peaks, self.top = None, {}, 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        nested = self.nested.setdefault(threading.get_ident(), [])
+        traced = tracemalloc.is_tracing()
+        if traced:
+            self.notePeak(nested)
+            tracemalloc.reset_peak()
+        nested.append([0, 0])
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            inner, peak = nested.pop()
+            with self.lock:
+                self.times[name] = self.times.get(name, 0) + elapsed - inner
+            if traced:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                with self.lock:
+                    self.peaks[name] = max(self.peaks.get(name, 0), peak)
+            if nested:
+                nested[-1][0] = nested[-1][0] + elapsed
+                nested[-1][1] = max(nested[-1][1], peak)
+
+    # Add the current traced peak to the phases of the stack nested, and to top
+    def notePeak(self, nested):
+        peak = tracemalloc.get_traced_memory()[1]
+        for entry in nested:
+            entry[1] = max(entry[1], peak)
+        self.top = max(self.top, peak)
+
+    # Peak memory traced since the profile started (see phase), when tracemalloc is tracing
+    def tracedPeak(self):
+        self.notePeak([])
+        return max([self.top] + list(self.peaks.values()))
+
+    def count(self, name, k=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + int(k)
+
+    # Add the summary of another profile (see summary)
+    def merge(self, summary):
+        for name, value in summary["phases"].items():
+            self.times[name] = self.times.get(name, 0) + value
+        for name, value in summary["counters"].items():
+            self.count(name, value)
+        if "peak_memory" in summary:
+            self.peak = max(self.peak or 0, summary["peak_memory"])
+        for name, value in summary.get("phase_peak_memory", {}).items():
+            self.peaks[name] = max(self.peaks.get(name, 0), value)
+
+    def summary(self):
+        summary = {"phases": dict(self.times), "counters": dict(self.counts)}
+        if self.peak is not None:
+            summary["peak_memory"] = self.peak
+            summary["phase_peak_memory"] = dict(self.peaks)
+        return summary
+
+    # the lock cannot be pickled with the profile
+    def __getstate__(self):
+        return dict(self.__dict__, lock = None)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, lock = threading.Lock())
+
+
+# Profile being recorded (None when not profiling) by profilePhase, profiled and the counters
+PROFILE = None
+NO_PHASE = contextlib.nullcontext()
+
+
+def profilePhase(name):
+    return PROFILE.phase(name) if PROFILE else NO_PHASE
+
+
+# Decorator recording every call of the function as the phase name
+def profiled(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if PROFILE is None:
+                return function(*args, **kwargs)
+            with PROFILE.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+
+class CompactTree:
+    # Array based topology of a rooted binary tree, used in place of ete3 trees inside compareTree
+    # Every node is an integer id indexing the parallel lists parent, left and right (-1 where there is no such node) and
+    # name (the leaf label, None for internal nodes). Nodes are only ever appended, so ids stay valid while subtrees are
+    # grafted, moved and deleted. The child lists behave like ete3's: a new child goes after the existing one, and removing
+    # the left child moves the right child into its place
+    # reindex() recomputes the postorder, the leaf counts (leafCount), the subtree sizes in nodes (size) and the leaf label
+    # to id index (leafId) of the tree currently hanging from root
+    # Copies share the node lists until one of them is modified (copy on write): owners counts the compact trees sharing
+    # the current lists, and every method modifying the tree first calls own()
+    # own() also counts the modifications in version; indexed is the version the current index was computed at, so that
+    # refresh() only reindexes trees that changed since their last reindex
+    def __init__(self, T=None):
+        self.parent, self.left, self.right, self.name = [], [], [], []
+        self.owners = [1]
+        self.version, self.indexed = 0, -1
+        self.root = -1
+        self.postorder, self.leafCount, self.size, self.leafId = [], [], [], {}
+        self.clusters = None
+        # when set, the root is turned into a multifurcation (ete3 unroot) when converting back to ete3
+        self.unrooted = False
+        if T is not None:
+            self.root = self.addNode()
+            stack = [(T, self.root)]
+            while stack:
+                node, v = stack.pop()
+                if node.is_leaf():
+                    self.name[v] = node.name
+                for child in node.children:
+                    c = self.addNode()
+                    self.addChild(v, c)
+                    stack.append((child, c))
+            self.reindex()
+
+
+    # The cluster index holds leaf indices interned in this process (see LEAF_INDEX), which mean nothing in another
+    # process, so it is left out when the tree is pickled (sent to or from a worker process) and recomputed there
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["clusters"] = None
+        return state
+
+
+    # Give this tree its own node lists if they are shared with copies, and record the modification
+    def own(self):
+        self.version = self.version + 1
+        if self.owners[0] > 1:
+            self.owners[0] = self.owners[0] - 1
+            self.parent, self.left, self.right, self.name = self.parent[:], self.left[:], self.right[:], self.name[:]
+            self.owners = [1]
+
+
+    def addNode(self, name=None):
+        self.own()
+        self.parent.append(-1)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.name.append(name)
+        return len(self.parent) - 1
+
+
+    def addChild(self, p, c):
+        self.own()
+        if self.left[p] == -1:
+            self.left[p] = c
+        elif self.right[p] == -1:
+            self.right[p] = c
+        else:
+            raise ValueError("non binary tree")
+        self.parent[c] = p
+        return c
+
+
+    # remove c from the children of p, without touching the parent of c
+    def removeChild(self, p, c):
+        self.own()
+        if self.left[p] == c:
+            self.left[p], self.right[p] = self.right[p], -1
+        elif self.right[p] == c:
+            self.right[p] = -1
+
+
+    def detach(self, c):
+        self.own()
+        if self.parent[c] != -1:
+            self.removeChild(self.parent[c], c)
+            self.parent[c] = -1
+        return c
+
+
+    def children(self, v):
+        if self.left[v] == -1:
+            return []
+        if self.right[v] == -1:
+            return [self.left[v]]
+        return [self.left[v], self.right[v]]
+
+
+    def isLeaf(self, v):
+        return self.left[v] == -1
+
+
+    # Same as ete3's delete(): the children of v are appended to the children of its parent and v is removed. A parent
+    # left with a single child is deleted in turn
+    def delete(self, v, prevent_nondicotomic=True):
+        self.own()
+        p = self.parent[v]
+        if p != -1:
+            kids = [x for x in self.children(p) if x != v] + self.children(v)
+            self.left[p], self.right[p] = -1, -1
+            for x in kids:
+                self.addChild(p, x)
+            self.parent[v] = -1
+            if prevent_nondicotomic and len(kids) < 2:
+                self.delete(p, False)
+
+
+    # Copy the subtree rooted at v of the compact tree src into this tree, returns the id of the copied root
+    def copySubtree(self, src, v):
+        if PROFILE:
+            PROFILE.count("grafts")
+        root = self.addNode(src.name[v])
+        stack = [(v, root)]
+        while stack:
+            x, y = stack.pop()
+            for c in src.children(x):
+                stack.append((c, self.addChild(y, self.addNode(src.name[c]))))
+        return root
+
+
+    # The copy shares the node lists of the tree until either of them is modified (see own), so copying takes constant
+    # time and only trees that are actually modified are ever duplicated.
+    # With index, the copy also shares the current index of the tree (postorder, leafCount, size, leafId and the cluster
+    # index) instead of leaving it to be recomputed. This is safe because reindex() always builds new containers
+    def copy(self, index=False):
+        T = CompactTree()
+        T.parent, T.left, T.right, T.name = self.parent, self.left, self.right, self.name
+        T.owners = self.owners
+        self.owners[0] = self.owners[0] + 1
+        T.root, T.unrooted = self.root, self.unrooted
+        if index:
+            T.postorder, T.leafCount, T.size, T.leafId = self.postorder, self.leafCount, self.size, self.leafId
+            T.clusters = self.clusters
+            if self.indexed == self.version:
+                T.indexed = T.version
+        return T
+
+
+    def preorder(self, v=None):
+        stack = [self.root if v is None else v]
+        order = []
+        while stack:
+            v = stack.pop()
+            order.append(v)
+            if self.right[v] != -1:
+                stack.append(self.right[v])
+            if self.left[v] != -1:
+                stack.append(self.left[v])
+        return order
+
+
+    # leaves of the subtree rooted at v, from left to right
+    def leaves(self, v=None):
+        return [x for x in self.preorder(v) if self.left[x] == -1]
+
+
+    @profiled("reindex")
+    def reindex(self):
+        # reversing a node, right, left preorder gives the left, right, node postorder
+        stack, order = [self.root], []
+        while stack:
+            v = stack.pop()
+            order.append(v)
+            if self.left[v] != -1:
+                stack.append(self.left[v])
+            if self.right[v] != -1:
+                stack.append(self.right[v])
+        order.reverse()
+
+        self.postorder, self.leafCount, self.size, self.leafId = order, [0] * len(self.parent), [0] * len(self.parent), {}
+        for v in order:
+            if self.left[v] == -1:
+                self.leafCount[v], self.size[v] = 1, 1
+                self.leafId[self.name[v]] = v
+            else:
+                self.leafCount[v], self.size[v] = self.leafCount[self.left[v]], self.size[self.left[v]] + 1
+                if self.right[v] != -1:
+                    self.leafCount[v] = self.leafCount[v] + self.leafCount[self.right[v]]
+                    self.size[v] = self.size[v] + self.size[self.right[v]]
+        self.clusters = None
+        self.indexed = self.version
+
+
+    # reindex() unless the index is still the one of the current tree
+    def refresh(self):
+        if self.indexed != self.version:
+            self.reindex()
+
+
+    # Arrays describing the clusters of the tree for robinsonFoulds, computed once per indexing of the tree: the interned
+    # index of the leaf at every position of the postorder (-1 for internal nodes), and the position in the postorder
+    # where the subtree of the node at every position starts
+    def clusterIndex(self):
+        if self.clusters is None:
+            post = np.array(self.postorder, dtype=np.int64)
+            leaves = np.array([LEAF_INDEX.setdefault(self.name[v], len(LEAF_INDEX)) if self.left[v] == -1 else -1
+                               for v in self.postorder], dtype=np.int64)
+            self.clusters = leaves, np.arange(1, len(post) + 1) - np.array(self.size, dtype=np.int64)[post]
+        return self.clusters
+
+
+    # Same as ete3's set_outgroup(): reroot the tree so that the root has the outgroup as its first child. The root node is
+    # kept, and the path from the outgroup up to the old root is reversed
+    def setOutgroup(self, outgroup):
+        root = self.root
+        path = []
+        x = self.parent[outgroup]
+        while x != root:
+            path.append(x)
+            x = self.parent[x]
+
+        self.removeChild(root, path[-1] if path else outgroup)
+        down = self.left[root]
+        self.removeChild(root, down)
+        if path:
+            # every node on the path takes its former parent as its last child, and the top of the path takes the
+            # other side of the old root
+            self.removeChild(path[0], outgroup)
+            for k, q in enumerate(path):
+                if k + 1 < len(path):
+                    self.removeChild(path[k+1], q)
+                    self.addChild(q, path[k+1])
+                else:
+                    self.addChild(q, down)
+            down = path[0]
+        self.addChild(root, outgroup)
+        self.addChild(root, down)
+
+
+    # Hang a leaf called name next to the tree, as the first child of a new root, and mark the tree as unrooted
+    def addOutgroup(self, name):
+        root = self.addNode()
+        self.addChild(root, self.addNode(name))
+        self.addChild(root, self.root)
+        self.root = root
+        self.unrooted = True
+
+
+    # Build the ete3 tree hanging from the root, without recursion
+    @profiled("output")
+    def toEte(self):
+        T = Tree()
+        stack = [(self.root, T)]
+        while stack:
+            v, node = stack.pop()
+            if self.name[v] is not None:
+                node.name = self.name[v]
+            for c in self.children(v):
+                stack.append((c, node.add_child()))
+        if self.unrooted:
+            T.unroot()
+        return T
+
+
+    # Write the same newick text as toEte().write(format = 9) to the stream out, without building the ete3 tree and
+    # without recursion: leaf names only, unnamed leaves being called NoName, and an unrooted tree written with the
+    # children of a child of the root joined to the root as ete3's unroot() does. The pieces of text are collected in a
+    # buffer written out and reused every NEWICK_CHUNK pieces
+    @profiled("output")
+    def writeNewick(self, out):
+        left, right, name = self.left, self.right, self.name
+        root = self.root
+        top = self.children(root)
+        if self.unrooted and len(top) == 2:
+            if left[top[0]] != -1:
+                top = [top[1]] + self.children(top[0])
+            elif left[top[1]] != -1:
+                top = [top[0]] + self.children(top[1])
+            else:
+                raise TreeError("Cannot unroot a tree with only two leaves")
+
+        # the stack holds the nodes still to write, -1 for a closing parenthesis and -2 for a comma
+        buffer, stack = [], [root]
+        while stack:
+            v = stack.pop()
+            if v == -1:
+                buffer.append(")")
+            elif v == -2:
+                buffer.append(",")
+            elif (left[v] == -1) if v != root else not top:
+                buffer.append(str(name[v]).translate(NEWICK_ESCAPE) if name[v] else "NoName")
+            else:
+                buffer.append("(")
+                stack.append(-1)
+                kids = top if v == root else [left[v]] if right[v] == -1 else [left[v], right[v]]
+                for k in range(len(kids) - 1, 0, -1):
+                    stack.append(kids[k])
+                    stack.append(-2)
+                stack.append(kids[0])
+            if len(buffer) >= NEWICK_CHUNK:
+                out.write("".join(buffer))
+                buffer.clear()
+        buffer.append(";")
+        out.write("".join(buffer))
+
+
+    def newick(self):
+        out = io.StringIO()
+        self.writeNewick(out)
+        return out.getvalue()
+
+
+
+
+class ReferenceTree:
+    # A tree compared with many other trees, such as the first tree in the default mode of main(). Everything computed
+    # on the tree alone is built once and shared by every comparison: the indexed compact tree, its cluster index (see
+    # robinsonFoulds) and its LCA mapping for each RMQ backend. compareTree accepts a ReferenceTree in place of either
+    # input tree, and only works on a copy of it
+    def __init__(self, T):
+        self.tree = T if isinstance(T, CompactTree) else CompactTree(T)
+        if not self.tree.postorder:
+            self.tree.reindex()
+        self.tree.clusterIndex()
+        self.mappings = {}
+
+
+    def mapping(self, method="bfc"):
+        if method not in self.mappings:
+            self.mappings[method] = LCAMapping(self.tree, method)
+        return self.mappings[method]
+
+
+    def copy(self):
+        return self.tree.copy(index=True)
+
+
 
 
 
 class LCAMapping:
-    def __init__(self, Tree):
+    # method selects the RMQ backend used to answer LCA queries:
+    #   "bfc" - block decomposed +-1 RMQ (Bender and Farach-Colton), O(n) preprocessing and O(1) queries
+    #   "st"  - sparse table over the whole Euler tour, O(n log n) preprocessing and O(1) queries
+    # arrays, when given, are the arrays of a mapping of the same tree built before (see arrays()), which are used instead
+    # of being computed again
+    @profiled("lca build")
+    def __init__(self, Tree, method="bfc", arrays=None):
         self.tree = Tree
         self.array = []
-        self.lcaToRMQ()
-        self.preprocessST()
+        if arrays is not None:
+            self.leafId = self.tree.leafId
+            for name, value in arrays.items():
+                setattr(self, name, int(value) if name == "blockSize" else value)
+        else:
+            self.lcaToRMQ()
+        if method == "st":
+            if arrays is None:
+                self.preprocessST()
+            self.queryRMQ, self.queryRMQ_batch = self.queryST, self.queryST_batch
+        elif method == "bfc":
+            if arrays is None:
+                self.preprocessBFC()
+            self.queryRMQ, self.queryRMQ_batch = self.queryBFC, self.queryBFC_batch
+        else:
+            raise ValueError("unknown LCA method: {}".format(method))
 
 
-    # RMQ preprocessing using dynamic programming - O(n^2)
-    def preprocessDP(self):
-        n = len(self.levelLst)
-        self.array = []
-        for i in range(n):
-            L1 = []
-            for j in range(n):
-                if(j < i):
-                    L1.append('-')
-                elif(j == i):
-                    L1.append(i)
-                else:
-                    if(self.levelLst[L1[j-1]] > self.levelLst[j]):
-                        L1.append(j)
-                    else:
-                        L1.append(L1[j-1])
-            self.array.append(L1)
-        #print(array)
+    # the arrays of the Euler tour and RMQ structures, which determine the mapping of its tree
+    def arrays(self):
+        names = ["eTourLst", "levelLst", "repLst", "logTable", "array"]
+        if hasattr(self, "blockSize"):
+            names = names + ["blockSize", "blockMinPos", "blockType", "inBlock"]
+        return {name: np.asarray(getattr(self, name)) for name in names}
 
 
-    # RMQ preprocessing using Stable Table - O(nlogn)
-    def preprocessST(self):
-        self.array = []
-        x = int(math.log2(len(self.levelLst)))
-        for i in range(len(self.levelLst)):
-            self.array.append([])
-        for j in range(x+1):
-            for i in range(len(self.levelLst)):
-                if(j == 0):
-                    self.array[i].append(i)
-                else:
-                    if(i+ 2**(j-1) >= len(self.levelLst)):
-                        self.array[i].append('-')
-                    elif(self.array[i+ 2**(j-1)][j-1] == '-'):
-                        self.array[i].append('-')
-                    elif(self.levelLst[self.array[i][j-1]] <= self.levelLst [ self.array[i+ 2**(j-1)][j-1] ]):
-                        self.array[i].append(self.array[i][j-1])
-                    else:
-                        self.array[i].append(self.array[i+ 2**(j-1)][j-1])
+    # self.logTable[k] = floor(log2(k)) for 1 <= k <= n, so that queries never call math.log2
+    def setLogTable(self, n):
+        self.logTable = np.zeros(n + 1, dtype=np.int64)
+        x = 1
+        while (1 << x) <= n:
+            self.logTable[1 << x:] += 1
+            x = x + 1
 
-        #return array
 
+    # Row j of the returned table holds, for every start index i, the position of the (leftmost) minimum of values[i : i + 2**j]
+    # self.logTable must already cover len(values)
+    def sparseTable(self, values):
+        n = len(values)
+        table = np.zeros((self.logTable[n] + 1 if n else 1, n), dtype=np.int64)
+        table[0] = np.arange(n)
+        for j in range(1, len(table)):
+            half, span = 1 << (j-1), n - (1 << j) + 1
+            left, right = table[j-1, :span], table[j-1, half:half+span]
+            table[j, :span] = np.where(values[left] <= values[right], left, right)
+        return table
 
 
+    # RMQ preprocessing using Stable Table - O(nlogn)
+    def preprocessST(self):
+        self.setLogTable(len(self.levelLst))
+        self.array = self.sparseTable(self.levelLst)
 
 
     # query for stable table prepreprossing
@@ -91,9 +579,9 @@ class LCAMapping:
                 print('out of bounds')
                 return
 
-        k = int(math.log2(j - i))
-        x = self.array[i][k]
-        y = self.array[j-2**(k)+1][k]
+        k = self.logTable[j - i + 1]
+        x = self.array[k, i]
+        y = self.array[k, j-(1 << k)+1]
         if(self.levelLst[x] <= self.levelLst[y]):
             value = x
         else:
@@ -101,51 +589,183 @@ class LCAMapping:
         return value
 
 
+    # vectorized query for stable table preprocessing, i and j are arrays with i <= j elementwise
+    def queryST_batch(self, i, j):
+        k = self.logTable[j - i + 1]
+        x = self.array[k, i]
+        y = self.array[k, j - (1 << k) + 1]
+        return np.where(self.levelLst[x] <= self.levelLst[y], x, y)
+
+
+    # RMQ preprocessing for +-1 sequences (Bender and Farach-Colton) - O(n)
+    # Consecutive levels of an Euler tour differ by exactly one. The tour is cut into blocks of b = log2(n)/2 positions:
+    #   - a sparse table over the minima of the n/b blocks answers queries spanning whole blocks (O(n/b log n) = O(n) space)
+    #   - every block is normalized to the bit pattern of its +1/-1 steps, and since there are only 2^(b-1) <= sqrt(n)
+    #     such patterns, the position of the minimum of every range inside a block is tabulated once per pattern
+    def preprocessBFC(self):
+        n = len(self.levelLst)
+        b = max(1, int(math.log2(n)) // 2) if n > 1 else 1
+        nBlocks = -(-n // b)
+        self.blockSize = b
+
+        # pad the last block by continuing to step upwards, so that padding never holds a minimum of a real range
+        levels = np.empty(nBlocks * b, dtype=np.int64)
+        levels[:n] = self.levelLst
+        levels[n:] = self.levelLst[-1] + np.arange(1, nBlocks * b - n + 1)
+        blocks = levels.reshape(nBlocks, b)
+
+        # minimum of every block, and a sparse table over the block minima
+        self.blockMinPos = np.arange(nBlocks) * b + np.argmin(blocks, axis=1)
+        self.setLogTable(nBlocks)
+        self.array = self.sparseTable(levels[self.blockMinPos])
+
+        # the pattern of each block, bit k set when the level steps up between positions k and k+1 of the block
+        steps = (np.diff(blocks, axis=1) > 0).astype(np.int64)
+        self.blockType = (steps << np.arange(b-1, dtype=np.int64)).sum(axis=1)
+
+        # relative levels of every possible pattern, and the in-block answer for every pattern and range [i, j]
+        patterns = np.arange(1 << (b-1), dtype=np.int64)
+        bits = (patterns[:, None] >> np.arange(b-1, dtype=np.int64)) & 1
+        rel = np.zeros((len(patterns), b), dtype=np.int64)
+        rel[:, 1:] = np.cumsum(2 * bits - 1, axis=1)
+        self.inBlock = np.zeros((len(patterns), b, b), dtype=np.int64)
+        for i in range(b):
+            best, pos = rel[:, i].copy(), np.full(len(patterns), i, dtype=np.int64)
+            for j in range(i, b):
+                lower = rel[:, j] < best
+                best[lower], pos[lower] = rel[lower, j], j
+                self.inBlock[:, i, j] = pos
+
+
+    # query for +-1 RMQ preprocessing
+    def queryBFC(self, i, j):
+        b = self.blockSize
+        bi, bj = i // b, j // b
+        if bi == bj:
+            return bi * b + self.inBlock[self.blockType[bi], i - bi*b, j - bj*b]
+
+        # minimum of the suffix of the first block and of the prefix of the last block
+        x = bi * b + self.inBlock[self.blockType[bi], i - bi*b, b-1]
+        y = bj * b + self.inBlock[self.blockType[bj], 0, j - bj*b]
+        if self.levelLst[y] < self.levelLst[x]:
+            x = y
+
+        # minimum of the whole blocks in between
+        if bj - bi > 1:
+            k = self.logTable[bj - bi - 1]
+            y = self.blockMinPos[self.array[k, bi+1]]
+            z = self.blockMinPos[self.array[k, bj-(1 << k)]]
+            if self.levelLst[z] < self.levelLst[y]:
+                y = z
+            if self.levelLst[y] < self.levelLst[x]:
+                x = y
+        return x
+
+
+    # vectorized query for +-1 RMQ preprocessing, i and j are arrays with i <= j elementwise
+    def queryBFC_batch(self, i, j):
+        b = self.blockSize
+        bi, bj = i // b, j // b
+        same = bi == bj
+
+        # first block from i (up to j if both lie in the same block), last block up to j
+        x = bi * b + self.inBlock[self.blockType[bi], i - bi*b, np.where(same, j - bi*b, b-1)]
+        y = bj * b + self.inBlock[self.blockType[bj], 0, j - bj*b]
+        x = np.where(~same & (self.levelLst[y] < self.levelLst[x]), y, x)
+
+        # whole blocks in between, for queries spanning more than two blocks
+        between = bj - bi > 1
+        lo, hi = np.where(between, bi + 1, 0), np.where(between, bj - 1, 0)
+        k = self.logTable[hi - lo + 1]
+        y = self.blockMinPos[self.array[k, lo]]
+        z = self.blockMinPos[self.array[k, hi - (1 << k) + 1]]
+        y = np.where(self.levelLst[z] < self.levelLst[y], z, y)
+        return np.where(between & (self.levelLst[y] < self.levelLst[x]), y, x)
+
+
+    # eTourLst and levelLst hold the node ids and depths along the tour, and repLst holds, for every node id of the compact
+    # tree, the position of its first visit (-1 for nodes that are not in the tree)
+    # The tour is walked with an explicit stack of (node id, level, remaining children), so the depth of the tree is not
+    # limited by the Python recursion limit
     def eulerTour(self, node,lv):
-        self.eTourLst.append(node)
-        self.repLst[node.name] = len(self.eTourLst)-1
-        self.levelLst.append(lv)
-        if(node.is_leaf()):
-            return True
-        for nd in node.get_children():
-            self.eulerTour(nd,lv+1)
+        stack = []
+        while node != -1:
+            self.repLst[node] = len(self.eTourLst)
             self.eTourLst.append(node)
             self.levelLst.append(lv)
+            stack.append((node, lv, iter(self.tree.children(node))))
+
+            node = -1
+            while stack and node == -1:
+                v, lv, children = stack[-1]
+                node = next(children, -1)
+                if node == -1:
+                    # all children visited, return to the parent
+                    stack.pop()
+                    if stack:
+                        self.eTourLst.append(stack[-1][0])
+                        self.levelLst.append(stack[-1][1])
+                else:
+                    lv = lv + 1
 
 
     # convert LCA into RMQ
+    # The leaf index of the tree is kept as it was at this point, so leaves are still found by name after the tree is edited
     def lcaToRMQ(self):
+        self.leafId = self.tree.leafId
         self.eTourLst = []
         self.levelLst = []
-        self.repLst = {}
-        self.eulerTour(self.tree, 0)
+        self.repLst = [-1] * len(self.tree.parent)
+        self.eulerTour(self.tree.root, 0)
+        self.eTourLst = np.array(self.eTourLst, dtype=np.int64)
+        self.levelLst = np.array(self.levelLst, dtype=np.int64)
+        self.repLst = np.array(self.repLst, dtype=np.int64)
 
-    # query for LCA
+    # query for LCA of two node ids
     def queryLCA(self, node1, node2):
-        x = self.repLst.get(node1)
-        y = self.repLst.get(node2)
-        if x is None:
+        if PROFILE:
+            PROFILE.count("lca queries")
+        x = self.repLst[node1]
+        y = self.repLst[node2]
+        if x < 0:
             print("NONETYPE ERROR")
             print(node1)
         if(x == y):
             indexL = x
         elif(x > y):
-            indexL = self.queryST(y, x)
+            indexL = self.queryRMQ(y, x)
         elif(x < y):
-            indexL = self.queryST(x, y)
-        return self.eTourLst[indexL]
+            indexL = self.queryRMQ(x, y)
+        return int(self.eTourLst[indexL])
 
+    # query for the LCAs of many pairs of nodes at once, given as arrays of node ids. Returns an array of node ids
+    def queryLCA_batch(self, u_ids, v_ids):
+        if PROFILE:
+            PROFILE.count("lca queries", len(u_ids))
+        x = self.repLst[np.asarray(u_ids, dtype=np.int64)]
+        y = self.repLst[np.asarray(v_ids, dtype=np.int64)]
+        return self.eTourLst[self.queryRMQ_batch(np.minimum(x, y), np.maximum(x, y))]
 
 
 
 
-class compareTree:
-    def __init__(self, T, S):
-        self.colors = ["Green", "Red", "Blue", "Yellow"]
 
-        # Store the two completed trees
-        self.t = T.copy()
-        self.t2 = S.copy()
+class compareTree:
+    def __init__(self, T, S, lca="bfc"):
+        # RMQ backend used for every LCA mapping built during the comparison (see LCAMapping)
+        self.lca = lca
+
+        # Store the two completed trees. They are kept as compact trees (see CompactTree); the ete3 input trees are only read
+        # here, and ete3 trees are only built again for the completions returned to the caller
+        # The inputs may also be compact trees or reference trees, prepared once and shared by several comparisons, so
+        # they are copied. The copies of reference trees are kept in self.reference, with the reference they come from
+        self.reference = {}
+        for X, name in [(T, "t"), (S, "t2")]:
+            if isinstance(X, ReferenceTree):
+                setattr(self, name, X.copy())
+                self.reference[getattr(self, name)] = X
+            else:
+                setattr(self, name, X.copy(index=True) if isinstance(X, CompactTree) else CompactTree(X))
 
         # Store the EF-RF(+) completions, in the order that they are inputted to the initializer
         self.EF1 = None
@@ -155,9 +775,9 @@ class compareTree:
         self.RF1 = None
         self.RF2 = None
 
-        # Keep track of the color of each vertex
-        self.tcolors = {}
-        self.t2colors = {}
+        # Keep track of the color of each vertex, indexed by node id
+        self.tcolors = []
+        self.t2colors = []
 
         # Store which leaves are colored yellow and which leaves are colored red
         self.yellowLeaves, self.redLeaves = set(), set()
@@ -165,80 +785,78 @@ class compareTree:
         # Store half of the best possible change to the RF distance given that we push up any number of maximal
         # red and yellow subtrees, pair up whenever possible, and leave N maximal subtrees of color c unpaired
         # at the input vertex v
-        self.cost = {}
+        # All DP tables are flat arrays: the entries of vertex v and color c are the slice of length cMax1[c][v] + 1
+        # starting at self.dpIndex[c][v], indexed by N
+        self.cost, self.dpIndex = None, None
 
         # Store the maximum number of red (c=0) and yellow (c=1) subtrees contained within the subtree
-        # rooted at each vertex in self.t (self.cMax1) and self.t2 (self.cMax2)
-        self.cMax1, self.cMax2 = {}, {}
+        # rooted at each vertex in self.t (self.cMax1[c][v]) and self.t2 (self.cMax2[c][v])
+        self.cMax1, self.cMax2 = [[], []], [[], []]
 
         # Keep track of parameter values at each of the children which produce the optimal cost value
         # for the parent vertex given fixed parameter values N and c
-        self.leftN1, self.rightN1 = {}, {}
-        self.leftc1, self.rightc1 = {}, {}
+        self.leftN1, self.rightN1 = None, None
+        self.leftc1, self.rightc1 = None, None
 
-        # Keep track of optimal parameters
-        self.optN1, self.optc1 = {}, {}
-        self.order1, self.order2 = {}, {}
+        # Keep track of optimal parameters (indexed by vertex)
+        self.optN1, self.optc1 = None, None
 
-        self.iNode1, self.iNode2 = 0, 0     # if internal nodes are unnammed, name them based on numbers
         self.swapped = 0                    # to keep track of if t and t2 is T and S or if they are swapped
 
         self.init_swap, self.is_init = 0, None      # to keep track of the original order the two trees were inputted
+        self.mappings = {}
         self.resetT()
 
-        self.start_time = time.time()
+        # wall clock (time) and CPU (cpu) times of the EF-RF(+) and RF(+) completions
+        self.start_time, self.start_cpu = time.time(), time.process_time()
         self.EF_time, self.RF_time = None, None
+        self.EF_cpu, self.RF_cpu = None, None
 
 
 
-    def resetT(self):
+    def resetT(self, mapping=True):
         # swapping to set the smaller tree to be t, and larger tree to be t2
-        # a map of the name to node based on dictionary is made.
-
-        self.map = {}
-        self.t1Leafset = {}
-        self.t2Leafset = {}
-        t1LeafCount = 0
-        t2LeafCount = 0
-
-        self.iNode1 = 0
-        for node in self.t.traverse("postorder"):
-            # if internal node doesn't have a name, name it inode, increment inode
-            if(not node.is_leaf()):
-                self.iNode1 = self.iNode1 + 1
-                node.name = str(self.iNode1)
-            else:
-                t1LeafCount +=1
-                self.t1Leafset[str(node.name)] = t1LeafCount
-
-        self.iNode2 = 0
-        for node in self.t2.traverse("postorder"):
-            if(not node.is_leaf()):
-                self.iNode2 = self.iNode2 + 1
-                node.name = str(self.iNode2)
-            else:
-                t2LeafCount +=1
-                self.t2Leafset[str(node.name)] = t2LeafCount
+        # the postorder, leaf counts and leaf index are recomputed for the trees modified since they were last indexed,
+        # and the LCA mapping of t is only rebuilt if t changed (see lcaMapping)
+
+        for tree in [self.t, self.t2]:
+            tree.refresh()
 
-        if(t1LeafCount  > t2LeafCount):
+        if(self.t.leafCount[self.t.root] > self.t2.leafCount[self.t2.root]):
             temp = self.t
             self.t = self.t2
             self.t2 = temp
-            self.tLeafset = self.t2Leafset
             self.swapped = self.swapped + 1
 
             self.tcolors, self.t2colors = self.t2colors, self.tcolors
-            self.iNode1, self.iNode2 = self.iNode2, self.iNode1
 
             self.cMax1, self.cMax2 = self.cMax2, self.cMax1
 
             if self.is_init is None:
                 self.init_swap = 1
-        else:
-            self.tLeafset = self.t1Leafset
+
+        self.tLeafset = self.t.leafId
 
         self.is_init = 0
-        self.t1mapping = LCAMapping(self.t)
+        if mapping:
+            self.t1mapping = self.lcaMapping(self.t)
+
+
+    # LCA mapping of tree, which must be indexed. Untouched copies of reference trees use the mapping of their reference,
+    # and the mapping built for any other tree is kept until the tree is modified
+    # A comparison still builds two mappings of its own (counted as "lca builds" by --profile): t changes with the first
+    # one tree completion of computeEF, and t2 with the second one before computeRF maps t into it. Updating a mapping
+    # in place for the grafted subtrees is not supported
+    def lcaMapping(self, tree):
+        if tree in self.reference and tree.version == 0:
+            return self.reference[tree].mapping(self.lca)
+        version, mapping = self.mappings.get(tree, (None, None))
+        if version != tree.version:
+            if PROFILE:
+                PROFILE.count("lca builds")
+            mapping = LCAMapping(tree, self.lca)
+            self.mappings[tree] = (tree.version, mapping)
+        return mapping
 
 
 
@@ -249,280 +867,185 @@ class compareTree:
         # Note that the yellow and red leaves are stored precisely to keep track of which subtrees should be which colors
         #     after the EF-RF(+) completions have been computed
 
-        for node in self.t.traverse("postorder"):
-            if node.is_leaf():
-                if node.name in self.redLeaves:
-                    self.tcolors[node.name] = self.colors[1]
-                elif node.name in self.yellowLeaves:
-                    self.tcolors[node.name] = self.colors[3]
-                else:
-                    self.tcolors[node.name] = self.colors[0]
+        for i, tree in enumerate([self.t, self.t2]):
+            leafColors = np.full(len(tree.parent), GREEN, dtype=np.int8)
+            leafColors[[tree.leafId[x] for x in tree.leafId.keys() & self.yellowLeaves]] = YELLOW
+            leafColors[[tree.leafId[x] for x in tree.leafId.keys() & self.redLeaves]] = RED
+            if i == 0:
+                self.tcolors, mark, self.cMax1 = self.colorTree(tree, leafColors)
             else:
-                numGRB = [0,0,0,0]    # to count the number of green, red, blue and yellow children of the node
-                # count the number of child depending on color
-                for child in node.children:
-                    if(self.tcolors[child.name] == "Green"):
-                        numGRB[0] = numGRB[0] + 1
-                    elif(self.tcolors[child.name] == "Red"):
-                        numGRB[1] = numGRB[1] + 1
-                    elif(self.tcolors[child.name] == "Blue"):
-                        numGRB[2] = numGRB[2] + 1
-                    elif(self.tcolors[child.name] == "Yellow"):
-                        numGRB[3] = numGRB[3] + 1
-                # if both child are green, make color of node green.
-                if(numGRB[0] == 2):
-                    self.tcolors[node.name] = self.colors[0]
-                    node.add_features(mark = False)
-                # if both child are red, then make color of node red
-                elif(numGRB[1] == 2):
-                    self.tcolors[node.name] = self.colors[1]
-                    node.add_features(mark = False)
-                # if both child are yellow, then make color of node yellow
-                elif(numGRB[3] == 2):
-                    self.tcolors[node.name] = self.colors[3]
-                    node.add_features(mark = False)
-                # if one child is red (or yellow), and the other is green or blue, color node blue and mark node
-                elif((numGRB[1] == 1 or numGRB[3] == 1) and (numGRB[0] == 1 or numGRB[2] == 1)):
-                    self.tcolors[node.name] = self.colors[2]
-                    node.add_features(mark = True)
-
-                # otherwise make node blue, unmarked
-                else:
-                    self.tcolors[node.name] = self.colors[2]
-                    node.add_features(mark = False)
-
-        for node in self.t2.traverse("postorder"):
-            if node.is_leaf():
-                if node.name in self.redLeaves:
-                    self.t2colors[node.name] = self.colors[1]
-                elif node.name in self.yellowLeaves:
-                    self.t2colors[node.name] = self.colors[3]
-                else:
-                    self.t2colors[node.name] = self.colors[0]
-            else:
-                numGRB = [0,0,0,0]    # to count the number of green, red, blue and yellow children of the node
-                # count the number of child depending on color
-                for child in node.children:
-                    if(self.t2colors[child.name] == "Green"):
-                        numGRB[0] = numGRB[0] + 1
-                    elif(self.t2colors[child.name] == "Red"):
-                        numGRB[1] = numGRB[1] + 1
-                    elif(self.t2colors[child.name] == "Blue"):
-                        numGRB[2] = numGRB[2] + 1
-                    elif(self.t2colors[child.name] == "Yellow"):
-                        numGRB[3] = numGRB[3] + 1
-                # if both child are green, make color of node green.
-                if(numGRB[0] == 2):
-                    self.t2colors[node.name] = self.colors[0]
-                    node.add_features(mark = False)
-                # if both child are red, then make color of node red
-                elif(numGRB[1] == 2):
-                    self.t2colors[node.name] = self.colors[1]
-                    node.add_features(mark = False)
-                # if both child are yellow, then make color of node yellow
-                elif(numGRB[3] == 2):
-                    self.t2colors[node.name] = self.colors[3]
-                    node.add_features(mark = False)
-                # if one child is red (or yellow), and the other is green or blue, color node blue and mark node
-                elif((numGRB[1] == 1 or numGRB[3] == 1) and (numGRB[0] == 1 or numGRB[2] == 1)):
-                    self.t2colors[node.name] = self.colors[2]
-                    node.add_features(mark = True)
-                # otherwise make node blue, unmarked
-                else:
-                    self.t2colors[node.name] = self.colors[2]
-                    node.add_features(mark = False)
+                self.t2colors, mark, self.cMax2 = self.colorTree(tree, leafColors)
+
+
+
+    @profiled("color")
+    def colorTree(self, tree, leafColors):
+        # Color every node of tree given the colors of its leaves (leafColors, indexed by node id), in one sweep:
+        #   - a node is green, red or yellow when both of its children have that color, and blue otherwise, i.e. when all
+        #     leaves below it have that color
+        #   - a node is marked when one child is red or yellow and the other child is green or blue
+        #   - cMax[0][v] and cMax[1][v] count the maximal red and yellow subtrees (whose parent has another color)
+        #     contained in the subtree rooted at v
+        # Every subtree is a contiguous run of the postorder, so the counts of leaves and maximal subtrees below all nodes
+        # are differences of prefix sums along the postorder and are computed for all nodes at once.
+        # The returned arrays are indexed by node id, with one extra entry for the index -1 (color NONE, no mark, count 0)
+        n = len(tree.parent)
+        post = np.array(tree.postorder, dtype=np.int64)
+        left, right = np.array(tree.left, dtype=np.int64), np.array(tree.right, dtype=np.int64)
+        parent = np.array(tree.parent, dtype=np.int64)
+        start = np.arange(1, len(post) + 1) - np.array(tree.size, dtype=np.int64)[post]
+
+        def subtreeSums(values):
+            sums = np.zeros(len(post) + 1, dtype=np.int64)
+            np.cumsum(values, out=sums[1:])
+            return sums[1:] - sums[start]
+
+        isLeaf = left[post] == -1
+        counts = [subtreeSums(isLeaf & (leafColors[post] == c)) for c in [GREEN, RED, YELLOW]]
+        total = counts[0] + counts[1] + counts[2]
+
+        colors = np.full(n + 1, NONE, dtype=np.int8)
+        colors[post] = BLUE
+        for c, count in zip([GREEN, RED, YELLOW], counts):
+            colors[post[count == total]] = c
 
+        redYellow = (colors == RED) | (colors == YELLOW)
+        greenBlue = (colors == GREEN) | (colors == BLUE)
+        mark = np.zeros(n + 1, dtype=bool)
+        mark[post] = (redYellow[left[post]] & greenBlue[right[post]]) | (greenBlue[left[post]] & redYellow[right[post]])
 
+        cMax = []
+        for c in [RED, YELLOW]:
+            counts = np.zeros(n + 1, dtype=np.int64)
+            counts[post] = subtreeSums((colors[post] == c) & (colors[parent[post]] != c))
+            cMax.append(counts)
 
+        return colors, mark, cMax
+
+
+
+    @profiled("graft")
     def ROT_RF_Plus(self):
-        #tree.traverse("postorder") is ETE function which tranverse the tree in postorder
+        # self.t2.postorder is the postorder of the second tree, computed when it was last reindexed
+
+        # coloring each leaf of the second tree green, or red (yellow) when it is missing from the first tree
+        missing = [self.t2.leafId[x] for x in self.t2.leafId.keys() - self.tLeafset.keys()]
+        leafColors = np.full(len(self.t2.parent), GREEN, dtype=np.int8)
+        if self.swapped % 2 == 1:
+            leafColors[missing] = YELLOW
+            self.yellowLeaves.update(self.t2.name[x] for x in missing)
+        else:
+            leafColors[missing] = RED
+            self.redLeaves.update(self.t2.name[x] for x in missing)
 
-        for node in self.t2.traverse("postorder"):
-            if node.is_leaf():     # coloring each leaf red or green
-                if(self.tLeafset.get(str(node.name)) != None):
-                    node.add_features(mark = False)
-                    self.t2colors[node.name] = self.colors[0]
-                else:
-                    if self.swapped % 2 == 1:
-                        self.t2colors[node.name] = self.colors[3]
-                        self.yellowLeaves.add(node.name)
-                    else:
-                        self.t2colors[node.name] = self.colors[1]
-                        self.redLeaves.add(node.name)
-                    node.add_features(mark = False)
-            else:   # coloring the internal nodes
-                numGRB = [0,0,0,0]    # to count the number of green, red, blue and yellow children of the node
-                # count the number of child depending on color
-                for child in node.children:
-                    if(self.t2colors[child.name] == "Green"):
-                        numGRB[0] = numGRB[0] + 1
-                    elif(self.t2colors[child.name] == "Red"):
-                        numGRB[1] = numGRB[1] + 1
-                    elif(self.t2colors[child.name] == "Blue"):
-                        numGRB[2] = numGRB[2] + 1
-                    elif(self.t2colors[child.name] == "Yellow"):
-                        numGRB[3] = numGRB[3] + 1
-                # if both child are green, make color of node green.
-                if(numGRB[0] == 2):
-                    self.t2colors[node.name] = self.colors[0]
-                    node.add_features(mark = False)
-                # if both child are red, then make color of node red
-                elif(numGRB[1] == 2):
-                    self.t2colors[node.name] = self.colors[1]
-                    node.add_features(mark = False)
-                # if both child are yellow, then make color of node yellow
-                elif(numGRB[3] == 2):
-                    self.t2colors[node.name] = self.colors[3]
-                    node.add_features(mark = False)
-                # if one child is red (or yellow), and the other is green or blue, color node blue and mark node
-                elif((numGRB[1] == 1 or numGRB[3] == 1) and (numGRB[0] == 1 or numGRB[2] == 1)):
-                    self.t2colors[node.name] = self.colors[2]
-                    node.add_features(mark = True)
-                # otherwise make node blue, unmarked
-                else:
-                    self.t2colors[node.name] = self.colors[2]
-                    node.add_features(mark = False)
+        # coloring the internal nodes
+        self.t2colors, mark = self.colorTree(self.t2, leafColors)[:2]
 
         # If there are NO green leaves, then there are also no blue leaves, and hence we cannot just follow the algorithm.
         #     (In this case, there is also no possible EF-RF completion)
         # A pair of trees in this form is technically not an instance of the ROT-RF(+) problem. However, following through
         #     with this case in the ROT_RF(+) method will be convenient for computing the optimal R-RF(+) completions
-        if self.t2colors[self.t2.name] == "Red" or self.t2colors[self.t2.name] == "Yellow":
-            newT = Tree()
-            newT.add_child(self.t)
-            z = newT.add_child(self.t2.copy())
-            if not z.is_leaf():
-                self.iNode1 = self.iNode1 + 1
-                z.name = str(self.iNode1)
-            self.iNode1 = self.iNode1 + 1
-            newT.name = str(self.iNode1)
-            self.t = newT
-            self.tcolors[z.name] = self.t2colors[self.t2.name]
-            self.tcolors[newT.name] = self.colors[2]
-            return
-
-            newT2 = Tree()
-            newT2.add_child(self.t2)
-            z = newT2.add_child(self.t.copy())
-            if not z.is_leaf():
-                self.iNode2 = self.iNode2 + 1
-                z.name = str(self.iNode2)
-            self.iNode2 = self.iNode2 + 1
-            newT2.name = str(self.iNode2)
-            self.t2 = newT2
-            self.t2colors[z.name] = self.tcolors[self.t2.name]
-            self.t2colors[newT2.name] = self.colors[2]
-            self.EF_exists = False
+        if self.t2colors[self.t2.root] == RED or self.t2colors[self.t2.root] == YELLOW:
+            newT = self.t.addNode()
+            self.t.addChild(newT, self.t.root)
+            self.t.addChild(newT, self.t.copySubtree(self.t2, self.t2.root))
+            self.t.root = newT
             return
 
 
         # If at least one leaf is green, then the optimal RF completion can be formed by following the algorithm
         self.EF_exists = True
 
-        #ETE function to tranverse the tree in postorder (the second tree in this case)
-        for node in self.t2.traverse("postorder"):
-            # mapping
-            # when the node is green
-            #print(self.t2colors[node.name], node, "\n\n")
-            if(self.t2colors[node.name] == self.colors[0]):
-                if(node.is_leaf()):
-                    # in the dictionary, map the name of the node to the node in the first tree
-
-                    self.map[node.name] = self.t1mapping.queryLCA(node.name, node.name)
-                else:
-                    # get a list of all the children, and find the common ancestor of the children
-                    lst = []
-                    for child in node.children:
-                        #print(child)
-                        lst.append(self.map.get(child.name))
-                    #print("Here is the node and list:\t", node, lst, "\n\n")
-
-                    # ETE function to get common ancestor of a list of leaves or nodes
-                    #nd = self.t.get_common_ancestor(lst)
-					# now geting the common ancestor using the LCA mapping
-                    nd = self.t1mapping.queryLCA(lst[0].name, lst[1].name)
-
-                    # map the name of the node to the ancestor node in the first tree
-                    self.map[node.name] = nd
-
-            # when the node is blue
-            elif(self.t2colors[node.name] == self.colors[2]):
-                lst = []
-                # and the children that are green or blue to the list
-                for child in node.children:
-                    if(self.t2colors[child.name] == self.colors[0] or self.t2colors[child.name] == self.colors[2]):
-                        lst.append(self.map.get(child.name))
-
-                # when there is only one node in the list, use that node is the common ancestor
-                # otherwise get the greatest ancestor of the list of nodes in the first
+        # mapping
+        # every green or blue node of the second tree is mapped to the LCA, in the first tree, of its green and blue children
+        self.map = self.lcaMapByLevel(self.t2, self.t1mapping, self.t2colors)
 
-                if(len(lst) == 1):
-                    if(lst[0].is_leaf()):
-                        nd = lst[0]
-                    else:
-                        #nd = self.t.get_common_ancestor(lst[0].children)
-                        nd = self.t1mapping.queryLCA(lst[0].name, lst[0].name)
-                    self.map[node.name] = nd
-                elif(len(lst) == 2):
-                    nd = self.t1mapping.queryLCA(lst[0].name,lst[1].name)
-                    self.map[node.name] = nd
-                else:
-                    print('non binary tree')
-        #ETE function to tranverse tree in preorder
-        for node in self.t2.traverse("preorder"):
+        #tranverse the second tree in preorder
+        for node in self.t2.preorder():
             #tree-add
             # if the node is marked, meaning that one child is red
-            if(node.mark == True):
-                for child in node.children:
-                    # when the child is red, add it that node to the first tree.
+            if(mark[node] == True):
+                for child in self.t2.children(node):
+                    # when the child is red, add a copy of it to the first tree.
                     # if the node is the root, then the node is a sibling, to the current tree,
                     # and you have to create a new root
                     # otherwise, you have to detach the maping of the node in the first tree, and
                     # create a new tree with the detach node and the node you want to add as sibling.
                     # this new tree is then added to location where the node was detached in the first tree.
-                    if(self.t2colors[child.name] == self.colors[1] or self.t2colors[child.name] == self.colors[3]):
-                        nd = self.map.get(node.name)
+                    if(self.t2colors[child] == RED or self.t2colors[child] == YELLOW):
+                        nd = self.map[node]
                         # Case: red/yellow subtree attached at root
-                        if(nd.up == None):
-                            newT = Tree()
-                            newT.add_child(self.t)
-                            z = newT.add_child(child.copy())
-                            if not z.is_leaf():
-                                self.iNode1 = self.iNode1 + 1
-                                z.name = str(self.iNode1)
-                            self.iNode1 = self.iNode1 + 1
-                            newT.name = str(self.iNode1)
-                            self.t = newT
-                            self.tcolors[z.name] = self.t2colors[child.name]
-                            self.tcolors[newT.name] = self.colors[2]
+                        if(self.t.parent[nd] == -1):
+                            newT = self.t.addNode()
+                            self.t.addChild(newT, self.t.root)
+                            self.t.addChild(newT, self.t.copySubtree(self.t2, child))
+                            self.t.root = newT
                         #Case: red/yellow subtree attached at different internal node
                         else:
-                            up = nd.up
-                            newT = Tree()
-                            removed = nd.detach()
-                            z = newT.add_child(child.copy())
-                            if not z.is_leaf():
-                                self.iNode1 = self.iNode1 + 1
-                                z.name = str(self.iNode1)
-                            self.iNode1 = self.iNode1 + 1
-                            newT.name = str(self.iNode1)
-
-                            newT.add_child(removed)
-                            up.add_child(newT)
+                            up = self.t.parent[nd]
+                            removed = self.t.detach(nd)
+                            newT = self.t.addNode()
+                            self.t.addChild(newT, self.t.copySubtree(self.t2, child))
+                            self.t.addChild(newT, removed)
+                            self.t.addChild(up, newT)
+
+
+
+    @profiled("lca queries")
+    def lcaMapByLevel(self, tree, mapping, colors=None):
+        # Map the nodes of tree into the tree indexed by mapping: a leaf is mapped to the leaf with the same name, and an
+        # internal node to the LCA of the images of its children. If colors are given, only green and blue nodes are mapped,
+        # and only through their green and blue children. Returns the image of every node id (-1 for unmapped nodes).
+        # Nodes are grouped by their height above the leaves, so that all LCA queries of one level are answered in a single
+        # batched query instead of one query per node
+        images, height, levels = [-1] * len(tree.parent), [-1] * len(tree.parent), []
+        for node in tree.postorder:
+            if colors is not None and colors[node] != GREEN and colors[node] != BLUE:
+                continue
+            if tree.isLeaf(node):
+                x = mapping.leafId.get(tree.name[node])
+                if x is None:
+                    print("NONETYPE ERROR")
+                    print(tree.name[node])
+                images[node], height[node] = x, 0
+                continue
+
+            lst = [child for child in tree.children(node) if height[child] >= 0]
+            if len(lst) == 0 or len(lst) > 2:
+                print('non binary tree')
+                continue
+            h = 1 + max(height[x] for x in lst)
+            height[node] = h
+            if len(levels) < h:
+                levels.append([])
+            levels[h-1].append((node, lst))
+
+        for level in levels:
+            pairs = [lst for node, lst in level if len(lst) == 2]
+            if pairs:
+                lcas = mapping.queryLCA_batch([images[lst[0]] for lst in pairs], [images[lst[1]] for lst in pairs])
+            k = 0
+            for node, lst in level:
+                # a node with a single mapped child is mapped to the image of that child
+                if len(lst) == 1:
+                    images[node] = images[lst[0]]
+                else:
+                    images[node] = int(lcas[k])
+                    k = k + 1
 
-                            self.tcolors[z.name] = self.t2colors[child.name]
-                            self.tcolors[newT.name] = self.colors[2]
+        return images
 
 
 
-    def EF_R_RF(self):
+    def computeEF(self):
+        # Compute the rooted EF-RF(+) completions as compact trees (self.EF1, self.EF2)
 
         # If the EF-RF completions have been computed before, then they are stored in the compareTree class
         if self.EF1 and self.EF2:
-            return self.EF1, self.EF2
+            return
         # If not, then continue with computing the EF-RF completions
 
-        self.start_time = time.time()
+        self.start_time, self.start_cpu = time.time(), time.process_time()
 
         # calling the one tree completion function.
         # if there are missing leaves in both tree, then it is called twice
@@ -540,72 +1063,27 @@ class compareTree:
         self.ROT_RF_Plus()
 
 
+        # The completions are copy on write snapshots of both trees: the node lists are only duplicated if the trees are
+        # modified afterwards (by computeRF)
         if(self.swapped == 0 or self.swapped == 2):
-            self.EF1, self.EF2 = self.t.copy(), self.t2.copy()
+            self.EF1, self.EF2 = self.t.copy(index=True), self.t2.copy(index=True)
         else:
-            self.EF1, self.EF2 = self.t2.copy(), self.t.copy()
+            self.EF1, self.EF2 = self.t2.copy(index=True), self.t.copy(index=True)
 
-        self.EF_time = time.time() - self.start_time
-        return self.EF1, self.EF2
+        self.EF_time, self.EF_cpu = time.time() - self.start_time, time.process_time() - self.start_cpu
 
 
 
-    def setRedMax(self):
-        # Simple postorder traversal counting how many maximal red subtrees are contained
-        #     in the subtree rooted at each vertex
-        for v in self.t.traverse("postorder"):
-            if v.is_leaf():
-                if self.tcolors[v.name] == "Red" and self.tcolors[v.up.name] != "Red":
-                    self.cMax1[0, v.name] = 1
-                else:
-                    self.cMax1[0, v.name] = 0
-            else:
-                tempMax, redChildren = 0, 0
-                for child in v.children:
-                    if not self.tcolors[child.name] == "Red":
-                        tempMax = tempMax + self.cMax1[0, child.name]
-                    else:
-                        redChildren = redChildren + 1
-                if redChildren == 1:
-                    tempMax = tempMax + 1
-                elif redChildren == 2:
-                    if self.tcolors[v.name] == "Red" and self.tcolors[v.up.name] != "Red":
-                        tempMax = 1
-                    elif self.tcolors[v.name] != "Red":
-                        tempMax = 2
-                self.cMax1[0, v.name] = tempMax
-
-
-
-    def setYellowMax(self):
-        # Simple postorder traversal counting how many maximal yellow subtrees are contained
-        #     in the subtree rooted at each vertex
-        for v in self.t.traverse("postorder"):
-            if v.is_leaf():
-                if self.tcolors[v.name] == "Yellow" and self.tcolors[v.up.name] != "Yellow":
-                    self.cMax1[1, v.name] = 1
-                else:
-                    self.cMax1[1, v.name] = 0
-            else:
-                tempMax, yellowChildren = 0, 0
-                for child in v.children:
-                    if not self.tcolors[child.name] == "Yellow":
-                        tempMax = tempMax + self.cMax1[1, child.name]
-                    else:
-                        yellowChildren = yellowChildren + 1
-                if yellowChildren == 1:
-                    tempMax = tempMax + 1
-                elif yellowChildren == 2:
-                    if self.tcolors[v.name] == "Yellow" and self.tcolors[v.up.name] != "Yellow":
-                        tempMax = 1
-                    elif self.tcolors[v.name] != "Yellow":
-                        tempMax = 2
-                self.cMax1[1, v.name] = tempMax
+    def EF_R_RF(self):
+        self.computeEF()
+        return self.EF1.toEte(), self.EF2.toEte()
 
 
 
+    @profiled("pairExt")
     def pairExt(self):
-        redYellow = ["Red", "Yellow"]
+        redYellow = [RED, YELLOW]
+        t, t2 = self.t, self.t2
 
         # Determine if red (and yellow) subtrees came originally from the first or second input tree
         if self.init_swap == 0:
@@ -615,429 +1093,344 @@ class compareTree:
 
 
         # Keep track of which nodes will be deleted (since we are moving a grafted subtree) and
-        # in which cases, if any, we need to remove the root node and assign a new root node
+        # in which cases, if any, we need to remove the root node and assign a new root node (-1 otherwise)
         to_delete1, to_delete2 = [], []
         is_old_root1, is_old_root2 = [], []
 
 
         # Pair up corresponding extraneous clades
-        for v in self.t.traverse("postorder"):
-            if v.is_leaf():
-                self.order1[0, v.name], self.order1[1, v.name] = [], []
-                if self.tcolors[v.name] == "Red" and self.tcolors[v.up.name] != "Red":
-                    self.order1[0, v.name].append(v)
-                elif self.tcolors[v.name] == "Yellow" and self.tcolors[v.up.name] != "Yellow":
-                    self.order1[1, v.name].append(v)
-            else:
-                self.order1[0, v.name], self.order1[1, v.name] = [], []
-                for c in [0,1]:
-                    if self.tcolors[v.name] == redYellow[c] and self.tcolors[v.up.name] != redYellow[c]:
-                        self.order1[c, v.name].append(v)
-                    else:
-                        for child in v.children:
-                            self.order1[c, v.name].extend(self.order1[c, child.name])
+        # Pairing only rearranges nodes that were already visited, so the postorder computed before pairing stays valid
+        # The roots of the maximal red (c = 0) and yellow (c = 1) subtrees pushed up to each node v are kept, in order, in
+        # a linked list: head[c][v] and tail[c][v] are its first and last subtree, count[c][v] its length and nxt the next
+        # subtree of each one. A subtree is in a single list at a time, so the list of v is spliced from the lists of its
+        # children in constant time, and pairing or dropping the first subtrees of a list only walks over these subtrees,
+        # each of them being paired or dropped once
+        nxt = [-1] * len(t.parent)
+        head = [[-1] * len(t.parent) for c in [0, 1]]
+        tail = [[-1] * len(t.parent) for c in [0, 1]]
+        count = [[0] * len(t.parent) for c in [0, 1]]
+
+        for v in t.postorder:
+            for c in [0,1]:
+                if self.tcolors[v] == redYellow[c] and self.tcolors[t.parent[v]] != redYellow[c]:
+                    head[c][v], tail[c][v], count[c][v] = v, v, 1
+                    nxt[v] = -1
+                else:
+                    for child in t.children(v):
+                        if count[c][child]:
+                            if count[c][v]:
+                                nxt[tail[c][v]] = head[c][child]
+                            else:
+                                head[c][v] = head[c][child]
+                            tail[c][v], count[c][v] = tail[c][child], count[c][v] + count[c][child]
 
             # Keep track of the local optimal color and number of unpaired subtrees
-            C, N = self.optc1[v.name], self.optN1[v.name]
-            m = len(self.order1[C, v.name])
+            C, N = self.optc1[v], self.optN1[v]
+            m = count[C][v]
 
             # If both red and yellow subtrees have been pushed up to v, then pair up based on the order they appear.
             # After pairing, let the new order of color C be the order of the remaining unpaired subtrees,
             # and let the order of color 1-C be empty
 
-            if self.order1[0, v.name] and self.order1[1, v.name]:
+            if count[0][v] and count[1][v]:
+                first = [head[0][v], head[1][v]]
+                if PROFILE:
+                    PROFILE.count("pairings", m - N)
                 for n in range(m - N):
 
-                    newT1, newT2 = Tree(), Tree()
-
-                    ext_left1, ext_right1 = self.order1[0, v.name][n], self.order1[1, v.name][n]
-                    ext_left2, ext_right2 = self.map2[ext_left1.name], self.map2[ext_right1.name]
+                    ext_left1, ext_right1 = first
+                    first = [nxt[ext_left1], nxt[ext_right1]]
+                    ext_left2, ext_right2 = self.map2[ext_left1], self.map2[ext_right1]
 
                     if original_colors[0] == 0:
-                        up1, up2 = ext_left1.up, ext_right2.up
+                        up1, up2 = t.parent[ext_left1], t2.parent[ext_right2]
 
-                        to_delete1.append(ext_right1.up)
-                        to_delete2.append(ext_left2.up)
+                        to_delete1.append(t.parent[ext_right1])
+                        to_delete2.append(t2.parent[ext_left2])
 
-                        if ext_right1.up.up is not None:
-                            is_old_root1.append(None)
+                        if t.parent[t.parent[ext_right1]] != -1:
+                            is_old_root1.append(-1)
                         else:
-                            is_old_root1.append(ext_right1.up)
+                            is_old_root1.append(t.parent[ext_right1])
 
-                        if ext_left2.up.up is not None:
-                            is_old_root2.append(None)
+                        if t2.parent[t2.parent[ext_left2]] != -1:
+                            is_old_root2.append(-1)
                         else:
-                            is_old_root2.append(ext_left2.up)
+                            is_old_root2.append(t2.parent[ext_left2])
                     else:
-                        up1, up2 = ext_right1.up, ext_left2.up
+                        up1, up2 = t.parent[ext_right1], t2.parent[ext_left2]
 
-                        to_delete1.append(ext_left1.up)
-                        to_delete2.append(ext_right2.up)
+                        to_delete1.append(t.parent[ext_left1])
+                        to_delete2.append(t2.parent[ext_right2])
 
-                        if ext_right2.up.up is not None:
-                            is_old_root2.append(None)
+                        if t2.parent[t2.parent[ext_right2]] != -1:
+                            is_old_root2.append(-1)
                         else:
-                            is_old_root2.append(ext_right2.up)
+                            is_old_root2.append(t2.parent[ext_right2])
 
-                        if ext_left1.up.up is not None:
-                            is_old_root1.append(None)
+                        if t.parent[t.parent[ext_left1]] != -1:
+                            is_old_root1.append(-1)
                         else:
-                            is_old_root1.append(ext_left1.up)
-
-                    ext_left1, ext_right1 = ext_left1.detach(), ext_right1.detach()
-                    ext_left2, ext_right2 = ext_left2.detach(), ext_right2.detach()
+                            is_old_root1.append(t.parent[ext_left1])
 
-                    newT1.add_child(ext_left1)
-                    newT1.add_child(ext_right1)
-                    up1.add_child(newT1)
-                    newT2.add_child(ext_left2)
-                    newT2.add_child(ext_right2)
-                    up2.add_child(newT2)
+                    ext_left1, ext_right1 = t.detach(ext_left1), t.detach(ext_right1)
+                    ext_left2, ext_right2 = t2.detach(ext_left2), t2.detach(ext_right2)
 
-                self.order1[C, v.name], self.order1[1-C, v.name] = self.order1[C, v.name][m-N:], []
+                    newT1, newT2 = t.addNode(), t2.addNode()
+                    t.addChild(newT1, ext_left1)
+                    t.addChild(newT1, ext_right1)
+                    t.addChild(up1, newT1)
+                    t2.addChild(newT2, ext_left2)
+                    t2.addChild(newT2, ext_right2)
+                    t2.addChild(up2, newT2)
 
-            # If there are only maximal red subtrees, keep the last N of them
-            elif self.order1[0, v.name]:
-                if C == 0:
-                    self.order1[0, v.name] = self.order1[0, v.name][m-N:]
-                else:
-                    self.order1[0, v.name] = []
+                head[C][v], count[C][v] = first[C], N
+                count[1-C][v] = 0
 
-            # If there are only maximal yellow subtrees, keep the last N of them
-            elif self.order1[1, v.name]:
-                if C == 1:
-                    self.order1[1, v.name] = self.order1[1, v.name][m-N:]
-                else:
-                    self.order1[1, v.name] = []
+            # If there are only maximal red (or only maximal yellow) subtrees, keep the last N of them if they have
+            # the color C, and none of them otherwise
+            else:
+                for c in [0,1]:
+                    if count[c][v]:
+                        if c == C:
+                            for n in range(m - N):
+                                head[c][v] = nxt[head[c][v]]
+                            count[c][v] = N
+                        else:
+                            count[c][v] = 0
 
         # Once we have already merged ALL extraneous clades, then delete the redundant nodes
         # If deleting is done too early, then the subtree order that we keep track of will not properly collapse
         for n in range(len(to_delete1)):
-            if is_old_root1[n]:
-                self.t = is_old_root1[n].children[0]                    # We have already pruned the second child
-                self.t.up = None
+            if is_old_root1[n] != -1:
+                t.root = t.detach(t.left[is_old_root1[n]])          # We have already pruned the second child
             else:
-                to_delete1[n].delete()
+                t.delete(to_delete1[n])
 
-            if is_old_root2[n]:
-                self.t2 = is_old_root2[n].children[0]                    # We have already pruned the second child
-                self.t2.up = None
+            if is_old_root2[n] != -1:
+                t2.root = t2.detach(t2.left[is_old_root2[n]])       # We have already pruned the second child
             else:
-                to_delete2[n].delete()
-
+                t2.delete(to_delete2[n])
 
 
-    def EF_U_RF(self):
-        if self.EF1 and self.EF2:
-            return self.EF1, self.EF2
 
+    def rerootAtGreenLeaf(self):
         # Outgroup at some arbitrary green leaf and split accordingly to root
         #     leftover rooted tree in the proper place
-        outgroup1, outgroup2 = None, None
-        for leaf in self.t2:
-            if(self.tLeafset.get(str(leaf.name)) != None):
-                outgroup1 = self.t.get_leaves_by_name(str(leaf.name))[0]
-                outgroup2 = leaf
+        # The outgroup leaf is detached from both trees and its name is returned
+        name = None
+        for leaf in self.t2.leaves():
+            if(self.tLeafset.get(self.t2.name[leaf]) != None):
+                name = self.t2.name[leaf]
                 break
 
-        self.t.set_outgroup(outgroup1)
-        self.t2.set_outgroup(outgroup2)
-        T1, T2 = self.t, self.t2
+        for tree in [self.t, self.t2]:
+            outgroup = [leaf for leaf in tree.leaves() if tree.name[leaf] == name][0]
+            tree.setOutgroup(outgroup)
+            # set_outgroup always makes the outgroup the first child of the root
+            tree.root = tree.detach(tree.right[tree.root])
+            tree.detach(outgroup)
+            tree.reindex()
+        return name
 
-        if len(self.t.children[0]) == 1:
-            self.t = self.t.children[1].detach()
-            T1 = T1.children[0].detach()
-        else:
-            T1 = T1.children[1].detach()
-            self.t = self.t.children[0].detach()
 
-        if len(self.t2.children[0]) == 1:
-            self.t2 = self.t2.children[1].detach()
-            T2 = T2.children[0].detach()
-        else:
-            T2 = T2.children[1].detach()
-            self.t = self.t.children[0].detach()
 
-        T1.up, T2.up, self.t.up, self.t2.up = None, None, None, None
+    def computeUnrootedEF(self):
+        if not (self.EF1 and self.EF2):
+            name = self.rerootAtGreenLeaf()
 
-        # Compute EF-RF+ distance, add the green leaf back at the root and return the result
-        rooted1, rooted2 = self.EF_R_RF()
-        newT1, newT2 = Tree(), Tree()
-        newT1.add_child(T1)
-        newT1.add_child(rooted1)
-        newT2.add_child(T2)
-        newT2.add_child(rooted2)
-        self.EF1, self.EF2 = newT1, newT2
-        self.EF1.unroot()
-        self.EF2.unroot()
-        return self.EF1, self.EF2
+            # Compute EF-RF+ distance and add the green leaf back at the root
+            self.computeEF()
+            self.EF1.addOutgroup(name)
+            self.EF2.addOutgroup(name)
 
 
 
-    def U_RF_Plus(self):
-        if self.RF1 and self.RF2:
-            return self.RF1, self.RF2
+    def EF_U_RF(self):
+        self.computeUnrootedEF()
+        return self.EF1.toEte(), self.EF2.toEte()
 
-        # Outgroup at some arbitrary green leaf and split accordingly to root
-        #     leftover rooted tree in the proper place
-        outgroup1, outgroup2 = None, None
-        for leaf in self.t2:
-            if(self.tLeafset.get(str(leaf.name)) != None):
-                #print(leaf.name)
-                outgroup1 = self.t.get_leaves_by_name(str(leaf.name))[0]
-                outgroup2 = leaf
-                #print(outgroup1, outgroup2)
-                break
 
-        self.t.set_outgroup(outgroup1)
-        self.t2.set_outgroup(outgroup2)
-        T1, T2 = self.t, self.t2
 
-        if len(self.t.children[0]) == 1:
-            self.t = self.t.children[1].detach()
-            T1 = T1.children[0].detach()
-        else:
-            T1 = T1.children[1].detach()
-            self.t = self.t.children[0].detach()
+    def computeUnrootedRF(self):
+        if not (self.RF1 and self.RF2):
+            name = self.rerootAtGreenLeaf()
 
-        if len(self.t2.children[0]) == 1:
-            self.t2 = self.t2.children[1].detach()
-            T2 = T2.children[0].detach()
-        else:
-            T2 = T2.children[1].detach()
-            self.t = self.t.children[0].detach()
+            # Compute RF+ distance and add the green leaf back at the root
+            self.computeRF()
+            self.RF1.addOutgroup(name)
+            self.RF2.addOutgroup(name)
 
-        T1.up, T2.up, self.t.up, self.t2.up = None, None, None, None
 
-        # Compute RF+ distance, add the green leaf back at the root and return the result
-        rooted1, rooted2 = self.R_RF_Plus()
-        newT1, newT2 = Tree(), Tree()
-        newT1.add_child(T1)
-        newT1.add_child(rooted1)
-        newT2.add_child(T2)
-        newT2.add_child(rooted2)
-        self.RF1, self.RF2 = newT1, newT2
-        self.RF1.unroot()
-        self.RF2.unroot()
-        return self.RF1, self.RF2
 
+    def U_RF_Plus(self):
+        self.computeUnrootedRF()
+        return self.RF1.toEte(), self.RF2.toEte()
 
 
-    def R_RF_Plus(self):
+
+    def distances(self, unrooted=False):
+        # RF(+) and EF-RF(+) distances, the same as the Robinson-Foulds distances between the trees returned by
+        # R_RF_Plus and EF_R_RF (or U_RF_Plus and EF_U_RF when unrooted), but computed on the compact completions,
+        # without building ete3 trees
+        if unrooted:
+            self.computeUnrootedEF()
+            self.computeUnrootedRF()
+        else:
+            self.computeEF()
+            self.computeRF()
+        for T in [self.EF1, self.EF2, self.RF1, self.RF2]:
+            T.refresh()
+        return robinsonFoulds(self.RF1, self.RF2, unrooted), robinsonFoulds(self.EF1, self.EF2, unrooted)
+
+
+
+    @profiled("dp")
+    def computeRF(self):
+        # Compute the rooted RF(+) completions as compact trees (self.RF1, self.RF2)
 
         # If the RF(+) completions have already been computed, then they have been stored in the compareTree class
         if self.RF1 and self.RF2:
-            return self.RF1, self.RF2
+            return
         # Otherwise, continue with computing the RF(+) completions
 
-        self.start_time = time.time()
+        self.start_time, self.start_cpu = time.time(), time.process_time()
 
-        # First, call the EF-R-RF(+) completion function and preprocess any additional necessary information
-        # NOTE: If the EF-R-RF(+) completions have been computed already, then the EF_R_RF() method will be skipped
-        self.EF_R_RF()
+        # First, compute the EF-R-RF(+) completions and preprocess any additional necessary information
+        # NOTE: If the EF-R-RF(+) completions have been computed already, then computeEF() returns immediately
+        self.computeEF()
 
 
-        # We need to frequently relabel the internal nodes in the tree to be processed to prevent confusion between labels of internal nodes
-        self.resetT()
-
-        # The variable self.orig_root_name is only used as a check for the sagephy produced test cases
-        self.orig_root_name = self.t.name
+        # The trees have been changed by the EF-R-RF(+) completions, so both are reindexed (and swapped if needed). The LCA
+        # mapping used here is the one of t2
+        self.resetT(mapping=False)
 
+        # colors, marks and maximal red / yellow subtree counts of both trees
         self.recolor()
-        self.setRedMax()
-        self.setYellowMax()
 
 
         # Create LCA Mapping from self.t to self.t2 to determine which clades are matches
-        self.t2mapping = LCAMapping(self.t2)
-        self.map2 = {}
-        for node in self.t.traverse("postorder"):
-            if node.is_leaf():
-                self.map2[node.name] = self.t2mapping.queryLCA(node.name, node.name)
-            else:
-                lst = []
-                for child in node.children:
-                    lst.append(self.map2.get(child.name))
-                self.map2[node.name] = self.t2mapping.queryLCA(lst[0].name, lst[1].name)
+        self.map2 = self.lcaMapByLevel(self.t, self.lcaMapping(self.t2))
+
 
+        # Allocate the DP tables: the slice of vertex v and color c holds the entries for N = 0, ..., cMax1[c][v]
+        n = len(self.t.parent)
+        sizes = np.concatenate([self.cMax1[0][:n] + 1, self.cMax1[1][:n] + 1])
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.dpIndex = [offsets[:n], offsets[n:2 * n]]
+        # Leaves, and vertices with no maximal subtree of color c, keep cost 0 and all parameters 0
+        self.cost = np.zeros(offsets[-1])
+        if PROFILE:
+            PROFILE.count("dp cells", offsets[-1])
+        self.leftN1, self.rightN1 = np.zeros(offsets[-1], dtype=np.int64), np.zeros(offsets[-1], dtype=np.int64)
+        self.leftc1, self.rightc1 = np.zeros(offsets[-1], dtype=np.int8), np.zeros(offsets[-1], dtype=np.int8)
 
         # Now run the DP recurrence relation based off of self.t
-        for node in self.t.traverse("postorder"):
-            children, match = [], []
-            redYellow = ["Red", "Yellow"]
-            if node.is_leaf():
-                for c in [0,1]:
-                    self.cost[node.name, 0, c] = 0
-                    if self.tcolors[node.name] == redYellow[c] and self.tcolors[node.up.name] != redYellow[c]:
-                        self.cost[node.name, 1, c] = 0
+        redYellow = [RED, YELLOW]
+        for node in self.t.postorder:
+            if self.t.isLeaf(node):
+                continue
+
+            # First, determine the children of the node, and compute if each child is a match between the two EF-RF completions.
+            # If a child is a match, then there is a chance of the match being broken after moving red/yellow subtrees up
+            # (when the child is not the root of a maximal red/yellow subtree)
+            children, match = self.t.children(node), []
+            for child in children:
+                if self.t.leafCount[child] == self.t2.leafCount[self.map2[child]] and (self.tcolors[child] != RED and self.tcolors[child] != YELLOW):
+                    match.append(1)
+                else:
+                    match.append(0)
+
+            # Cost of pushing up NL (NR) subtrees of color cL (cR) from the left (right) child, for every value of NL (NR):
+            # the cost at the child plus the broken match when at least one subtree is pushed through the child
+            pushed = [[None, None], [None, None]]
+            for i in [0, 1]:
+                for cc in [0, 1]:
+                    start = self.dpIndex[cc][children[i]]
+                    pushed[i][cc] = self.cost[start:start + self.cMax1[cc][children[i]] + 1].copy()
+                    if self.tcolors[children[i]] != redYellow[cc]:
+                        pushed[i][cc][1:] += match[i]
+
+            # Compute the cost values for all possible values of c and N, given the vertex "node"
+            for c in [0,1]:
+                M = self.cMax1[c][node]
+                if M == 0:
+                    continue
+                start = self.dpIndex[c][node]
+                cost = np.full(M + 1, math.inf)
+                leftN, rightN = np.zeros(M + 1, dtype=np.int64), np.zeros(M + 1, dtype=np.int64)
+                leftc, rightc = np.zeros(M + 1, dtype=np.int8), np.zeros(M + 1, dtype=np.int8)
+
+                # Determine viable ranges for cL, cR, NL and NR, the input cost variables for each of the children
+                # Take the minimum possible value over all 4-tuples (cL, cR, NL, NR) as the cost at v with variables N, c.
+                # Save the optimal values for each of the four variables to construct the completion later
+                # Ties are always resolved in favour of the first (cL, cR) in product order, and within one (cL, cR) as
+                #     in the scan over NL (or n) that defines the recurrence, see minPlusSum and minPlusShift
+
+                # NOTE: The value of N represents the number of left over unpaired maximal red/yellow subtrees.
+                # Therefore, under the assumption that we always pair up opposite colored subtrees that have already been pushed
+                # up to the given vertex, we determine the possible values of NL and NL (quantities pushed from left, right respectively)
+                # DEPENDING on the values of cL and cR (colors of subtrees pushed from left, right respectively)
+
+                for cL, cR in itertools.product([0, 1], [0, 1]):
+                    a, b = self.cMax1[cL][children[0]], self.cMax1[cR][children[1]]
+
+                    # There are only three cases. The fourth case never results in the propoper color being pushed up to the specified node
+                    # The three meaningful cases are when
+                    #   1.) cL == cR == c,
+                    #   2.) cL == c != cR,
+                    #   3.) cR == c != cL
+
+                    # If the left and right pushed colors BOTH equal the desired pushed color, then the quantities of pushed subtrees from
+                    # each of the children must sum to N (since no extraneous clades can be formed)
+                    # For N <= b the candidates are scanned by increasing NL, and by decreasing NL otherwise
+                    if cL == cR == c:
+                        temp, first, last = minPlusSum(pushed[0][cL], pushed[1][cR])
+                        NL = np.where(np.arange(a + b + 1) <= b, first, last)
+                        NR = np.arange(a + b + 1) - NL
+                        # If the node is itself the root of a maximal subtree of color c (then a == b == 0 and M == 1),
+                        #     N = 1 is reached by pushing nothing from either child
+                        if M > a + b:
+                            temp, NL, NR = np.append(temp, temp[0]), np.append(NL, 0), np.append(NR, 0)
+
+                    # If cL == c != cR, then we know that there must be N more subtrees pushed from the left than the right,
+                    #     and the n subtrees pushed from the right are paired up
+                    # NOTE: The bound depends on whether or not each of the children is a maximal red/blue subtree
+                    elif cL == c:
+                        temp, NR = minPlusShift(pushed[0][cL], pushed[1][cR])
+                        NL = np.arange(a + 1) + NR
+
+                    # If cR == c != cL, then we know that there must be N more subtrees pushed from the right than the left
+                    # NOTE: The bound depends on whether or not each of the children is a maximal red/blue subtree
+                    elif cR == c:
+                        temp, NL = minPlusShift(pushed[1][cR], pushed[0][cL])
+                        NR = np.arange(b + 1) + NL
 
-            else:
-                # First, determine the children of the node, and compute if each child is a match between the two EF-RF completions.
-                # If a child is a match, then there is a chance of the match being broken after moving red/yellow subtrees up
-                # (when the child is not the root of a maximal red/yellow subtree)
-                for child in node.children:
-                    children.append(child)
-                    if len(child) == len(self.map2[child.name]) and (self.tcolors[child.name] != "Red" and self.tcolors[child.name] != "Yellow"):
-                        match.append(1)
                     else:
-                        match.append(0)
-
-                # Compute the cost values for all possible values of c and N, given the vertex "node"
-                for c in [0,1]:
-                    if self.cMax1[c, node.name] == 0:
-                        self.cost[node.name, 0, c] = 0
-                        self.leftN1[node.name, 0, c], self.rightN1[node.name, 0, c] = 0, 0
-                        self.leftc1[node.name, 0, c], self.rightc1[node.name, 0, c] = 0, 0
                         continue
 
-                    for N in range(self.cMax1[c, node.name] + 1):
+                    better = np.flatnonzero(temp < cost[:len(temp)])
+                    cost[better] = temp[better]
+                    leftN[better], rightN[better] = NL[better], NR[better]
+                    leftc[better], rightc[better] = cL, cR
+
+                self.cost[start:start + M + 1] = cost
+                self.leftN1[start:start + M + 1], self.rightN1[start:start + M + 1] = leftN, rightN
+                self.leftc1[start:start + M + 1], self.rightc1[start:start + M + 1] = leftc, rightc
 
-                        if self.cMax1[c, node.name] > 0:
-                            self.cost[node.name, N, c] = math.inf
-                        else:
-                            self.cost[node.name, N, c] = 0
-                        self.leftN1[node.name, N, c], self.rightN1[node.name, N, c] = 0, 0
-                        self.leftc1[node.name, N, c], self.rightc1[node.name, N, c] = 0, 0
-
-                        # Determine viable ranges for cL, cR, NL and NR, the input cost variables for each of the children
-                        # Iterate over all possible 4-tuples and set the cost at v with variables N, c as the minimum possible value
-                        #     over all 4-tuples (cL, cR, NL, NR).
-                        # Save the optimal values for each of the four variables to construct the completion later
-
-                        # NOTE: The value of N represents the number of left over unpaired maximal red/yellow subtrees.
-                        # Therefore, under the assumption that we always pair up opposite colored subtrees that have already been pushed
-                        # up to the given vertex, we determine the possible values of NL and NL (quantities pushed from left, right respectively)
-                        # DEPENDING on the values of cL and cR (colors of subtrees pushed from left, right respectively)
-
-                        for cL, cR in itertools.product([0, 1], [0, 1]):
-
-                            # There are only three cases. The fourth case never results in the propoper color being pushed up to the specified node
-                            # The three meaningful cases are when
-                            #   1.) cL == cR == c,
-                            #   2.) cL == c != cR,
-                            #   3.) cR == c != cL
-
-
-                            # If the left and right pushed colors BOTH equal the desired pushed color, then the quantities of pushed subtrees from
-                            # each of the children must sum to N (since no extraneous clades can be formed)
-                            if cL == cR == c:
-                                if N <= min(self.cMax1[cL, children[0].name], self.cMax1[cR, children[1].name]):
-                                    for n in range(N + 1):
-                                        NL = n
-                                        NR = N - n
-
-                                        temp = self.cost[children[0].name, NL, cL] + self.cost[children[1].name, NR, cR]
-                                        if NL > 0 and self.tcolors[children[0].name] != redYellow[cL]:
-                                            temp = temp + match[0]
-                                        if NR > 0 and self.tcolors[children[1].name] != redYellow[cR]:
-                                            temp = temp + match[1]
-                                        if temp < self.cost[node.name, N, c]:
-                                            self.cost[node.name, N, c] = temp
-                                            self.leftN1[node.name, N, c], self.rightN1[node.name, N, c] = NL, NR
-                                            self.leftc1[node.name, N, c], self.rightc1[node.name, N, c] = cL, cR
-
-                                elif N <= self.cMax1[cL, children[0].name]:
-                                    for n in range(self.cMax1[cR, children[1].name] + 1):
-                                        NL = N - n
-                                        NR = n
-
-                                        temp = self.cost[children[0].name, NL, cL] + self.cost[children[1].name, NR, cR]
-                                        if NL > 0 and self.tcolors[children[0].name] != redYellow[cL]:
-                                            temp = temp + match[0]
-                                        if NR > 0 and self.tcolors[children[1].name] != redYellow[cR]:
-                                            temp = temp + match[1]
-                                        if temp < self.cost[node.name, N, c]:
-                                            self.cost[node.name, N, c] = temp
-                                            self.leftN1[node.name, N, c], self.rightN1[node.name, N, c] = NL, NR
-                                            self.leftc1[node.name, N, c], self.rightc1[node.name, N, c] = cL, cR
-
-                                elif N <= self.cMax1[cR, children[1].name]:
-                                    for n in range(self.cMax1[cL, children[0].name] + 1):
-                                        NL = n
-                                        NR = N - n
-
-                                        temp = self.cost[children[0].name, NL, cL] + self.cost[children[1].name, NR, cR]
-                                        if NL > 0 and self.tcolors[children[0].name] != redYellow[cL]:
-                                            temp = temp + match[0]
-                                        if NR > 0 and self.tcolors[children[1].name] != redYellow[cR]:
-                                            temp = temp + match[1]
-                                        if temp < self.cost[node.name, N, c]:
-                                            self.cost[node.name, N, c] = temp
-                                            self.leftN1[node.name, N, c], self.rightN1[node.name, N, c] = NL, NR
-                                            self.leftc1[node.name, N, c], self.rightc1[node.name, N, c] = cL, cR
-
-                                else:
-                                    for n in range(self.cMax1[c, node.name] - N + 1):
-                                        NL = self.cMax1[cL, children[0].name] - n
-                                        NR = self.cMax1[cR, children[1].name] - self.cMax1[c, node.name] + N + n
-
-                                        temp = self.cost[children[0].name, NL, cL] + self.cost[children[1].name, NR, cR]
-                                        if NL > 0 and self.tcolors[children[0].name] != redYellow[cL]:
-                                            temp = temp + match[0]
-                                        if NR > 0 and self.tcolors[children[1].name] != redYellow[cR]:
-                                            temp = temp + match[1]
-                                        if temp < self.cost[node.name, N, c]:
-                                            self.cost[node.name, N, c] = temp
-                                            self.leftN1[node.name, N, c], self.rightN1[node.name, N, c] = NL, NR
-                                            self.leftc1[node.name, N, c], self.rightc1[node.name, N, c] = cL, cR
-
-                            # If cL == c != cR, then we know that there must be N more subtrees pushed from the left than the right
-                            # NOTE: The bound depends on whether or not each of the children is a maximal red/blue subtree
-                            elif cL == c and self.cMax1[cL, children[0].name] >= N:
-                                bound1 = self.cMax1[cL, children[0].name] - N
-
-                                bound2 = self.cMax1[cR, children[1].name]
-
-                                for n in range(min(bound1, bound2) + 1):
-                                    NL = N + n
-                                    NR = n
-
-                                    temp = self.cost[children[0].name, NL, cL] + self.cost[children[1].name, NR, cR] - n
-                                    if NL > 0 and self.tcolors[children[0].name] != redYellow[cL]:
-                                        temp = temp + match[0]
-                                    if NR > 0 and self.tcolors[children[1].name] != redYellow[cR]:
-                                        temp = temp + match[1]
-                                    if temp < self.cost[node.name, N, c]:
-                                        self.cost[node.name, N, c] = temp
-                                        self.leftN1[node.name, N, c], self.rightN1[node.name, N, c] = NL, NR
-                                        self.leftc1[node.name, N, c], self.rightc1[node.name, N, c] = cL, cR
-
-                            # If cR == c != cL, then we know that there must be N more subtrees pushed from the right than the left
-                            # NOTE: The bound depends on whether or not each of the children is a maximal red/blue subtree
-                            elif cR == c and self.cMax1[cR, children[1].name] >= N:
-                                bound1 = self.cMax1[cL, children[0].name]
-
-                                bound2 = self.cMax1[cR, children[1].name] - N
-
-                                for n in range(min(bound1, bound2) + 1):
-                                    NL = n
-                                    NR = N + n
-
-                                    temp = self.cost[children[0].name, NL, cL] + self.cost[children[1].name, NR, cR] - n
-                                    if NL > 0 and self.tcolors[children[0].name] != redYellow[cL]:
-                                        temp = temp + match[0]
-                                    if NR > 0 and self.tcolors[children[1].name] != redYellow[cR]:
-                                        temp = temp + match[1]
-                                    if temp < self.cost[node.name, N, c]:
-                                        self.cost[node.name, N, c] = temp
-                                        self.leftN1[node.name, N, c], self.rightN1[node.name, N, c] = NL, NR
-                                        self.leftc1[node.name, N, c], self.rightc1[node.name, N, c] = cL, cR
 
 
         # Determine top-down how to pair up extraneous clades
         # We can assume that the optimal number N of unpaired maximal colored trees (at the root) is equal to 0
         # Moreover, we can assume that these unpaired trees are red (0)
-        self.optN1[self.t.name], self.optc1[self.t.name] = 0, 0
-
-        for v in self.t.traverse("preorder"):
-            children = []
-            if not v.is_leaf():
-                for child in v.children:
-                    children.append(child)
-                self.optN1[children[0].name] = self.leftN1[v.name, self.optN1[v.name], self.optc1[v.name]]
-                self.optN1[children[1].name] = self.rightN1[v.name, self.optN1[v.name], self.optc1[v.name]]
-                self.optc1[children[0].name] = self.leftc1[v.name, self.optN1[v.name], self.optc1[v.name]]
-                self.optc1[children[1].name] = self.rightc1[v.name, self.optN1[v.name], self.optc1[v.name]]
+        self.optN1, self.optc1 = [0] * n, [0] * n
+
+        for v in self.t.preorder():
+            if not self.t.isLeaf(v):
+                children = self.t.children(v)
+                k = self.dpIndex[self.optc1[v]][v] + self.optN1[v]
+                self.optN1[children[0]], self.optN1[children[1]] = int(self.leftN1[k]), int(self.rightN1[k])
+                self.optc1[children[0]], self.optc1[children[1]] = int(self.leftc1[k]), int(self.rightc1[k])
 
         self.pairExt()
 
@@ -1047,13 +1440,327 @@ class compareTree:
             self.RF1, self.RF2 = self.t2, self.t
 
 
-        self.RF_time = time.time() - self.start_time
-        return self.RF1, self.RF2
+        self.RF_time, self.RF_cpu = time.time() - self.start_time, time.process_time() - self.start_cpu
+
+
+
+    def R_RF_Plus(self):
+        self.computeRF()
+        return self.RF1.toEte(), self.RF2.toEte()
+
+
 
 
 
+def minPlusSum(A, B):
+    # Min-plus convolution C[N] = min(A[i] + B[N - i]) of the cost vectors A and B, together with the smallest (first) and
+    # the largest (last) index i attaining the minimum for every N, ignoring infinite candidates.
+    # Only the shorter vector is scanned entry by entry, each step being one vectorized update against the whole longer
+    # vector, so the number of steps is min(len(A), len(B)) instead of len(A) + len(B) steps of up to min(len(A), len(B))
+    # candidates. The element-wise work is still len(A) * len(B)
+    a, b = len(A) - 1, len(B) - 1
+    C = np.full(a + b + 1, math.inf)
+    first, last = np.zeros(a + b + 1, dtype=np.int64), np.zeros(a + b + 1, dtype=np.int64)
+    for j in range(min(a, b) + 1):
+        if b <= a:
+            s, temp, i = slice(j, j + a + 1), A + B[j], np.arange(a + 1)
+        else:
+            s, temp, i = slice(j, j + b + 1), B + A[j], j
+        less, tie = temp < C[s], (temp == C[s]) & (temp < math.inf)
+        first[s] = np.where(less, i, np.where(tie, np.minimum(first[s], i), first[s]))
+        last[s] = np.where(less, i, np.where(tie, np.maximum(last[s], i), last[s]))
+        C[s] = np.minimum(C[s], temp)
+    return C, first, last
+
+
+
+def minPlusShift(A, B):
+    # C[N] = min(A[N + n] + B[n] - n) over 0 <= n <= min(len(A) - 1 - N, len(B) - 1), for N = 0, ..., len(A) - 1, together
+    # with the smallest n attaining the minimum (pairing n subtrees of B with n of the N + n subtrees of A).
+    # Every value of n is one vectorized update, so the number of steps is min(len(A), len(B)), the element-wise work
+    # being up to len(A) * len(B)
+    a, b = len(A) - 1, len(B) - 1
+    C, arg = np.full(a + 1, math.inf), np.zeros(a + 1, dtype=np.int64)
+    for n in range(min(a, b) + 1):
+        temp = A[n:] + (B[n] - n)
+        less = np.flatnonzero(temp < C[:a - n + 1])
+        C[less], arg[less] = temp[less], n
+    return C, arg
+
+
+
+
+
+def decompressor(path):
+    # The module (gzip, bz2 or lzma) decompressing the file, None if it is not compressed
+    with open(path, "rb") as f:
+        magic = f.read(6)
+    if magic.startswith(b"\x1f\x8b"):
+        return gzip
+    if magic.startswith(b"BZh"):
+        return bz2
+    if magic.startswith(b"\xfd7zXZ\x00"):
+        return lzma
+    return None
+
+
+def openInput(path):
+    # Open a text file for reading, decompressing it on the fly if it is compressed with gzip, bzip2 or xz
+    module = decompressor(path)
+    return module.open(path, "rt") if module else open(path)
+
+
+
+class TreeCache:
+    # Binary cache of prepared trees (--cache-dir of main()): for every newick line, the indexed compact tree, the start
+    # of the clusters of its cluster index (see CompactTree.clusterIndex) and the arrays of its LCA mapping for the RMQ
+    # backend lca are stored in an .npz file named by a hash of the line and of lca. Interned leaf indices depend on the run, so the
+    # cluster index is completed from the leaf names when a tree is loaded
+    FORMAT = "RF+ tree cache 1\n"
+
+    def __init__(self, directory, lca="bfc"):
+        self.directory, self.lca = directory, lca
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, line):
+        key = hashlib.sha256((self.FORMAT + self.lca + "\n" + line).encode()).hexdigest()
+        return os.path.join(self.directory, key + ".npz")
+
+    # The reference tree cached for line, None if it is not in the cache
+    def load(self, line):
+        path = self.path(line)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        T = CompactTree()
+        T.parent, T.left, T.right = arrays.pop("parent").tolist(), arrays.pop("left").tolist(), arrays.pop("right").tolist()
+        T.name = [None] * len(T.parent)
+        for v, name in zip(arrays.pop("leaves").tolist(), arrays.pop("names").tolist()):
+            T.name[v] = name
+        T.root, T.unrooted = int(arrays.pop("root")), bool(arrays.pop("unrooted"))
+        T.postorder, T.leafCount, T.size = [arrays.pop(name).tolist() for name in ["postorder", "leafCount", "size"]]
+        T.leafId = {T.name[v]: v for v in T.postorder if T.left[v] == -1}
+        T.indexed = T.version
+        starts = arrays.pop("starts")
+        T.clusters = np.array([LEAF_INDEX.setdefault(T.name[v], len(LEAF_INDEX)) if T.left[v] == -1 else -1
+                               for v in T.postorder], dtype=np.int64), starts
+        R = ReferenceTree(T)
+        R.mappings[self.lca] = LCAMapping(T, self.lca, arrays)
+        return R
+
+    # Prepare the tree T read from line as a reference tree (see ReferenceTree), with its LCA mapping, and cache it
+    def save(self, line, T):
+        R = ReferenceTree(T)
+        T = R.tree
+        leaves = [v for v in range(len(T.parent)) if T.left[v] == -1 and T.name[v] is not None]
+        arrays = {"parent": T.parent, "left": T.left, "right": T.right, "leaves": leaves,
+                  "names": np.array([T.name[v] for v in leaves], dtype=str), "root": T.root, "unrooted": T.unrooted,
+                  "postorder": T.postorder, "leafCount": T.leafCount, "size": T.size, "starts": T.clusterIndex()[1]}
+        arrays.update(R.mapping(self.lca).arrays())
+        # written under a temporary name first, so that concurrent runs never read a partial file
+        path = self.path(line)
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp, "wb") as f:
+            np.savez(f, **{name: np.asarray(value, dtype=np.int64) if isinstance(value, list) else value
+                           for name, value in arrays.items()})
+        os.replace(temp, path)
+        return R
+
+
+
+# Tokens of a newick string: the structural characters, and the text between them
+NEWICK_TOKENS = re.compile(r"[(),;]|[^(),;]+")
+# Leaf labels accepted by parseNewick, anything else (branch lengths, comments, quotes, ...) is left to ete3
+NEWICK_LABEL = re.compile(r"[^\s():;,\[\]'\"=]+")
+
+
+
+@profiled("parse")
+def parseNewick(x):
+    # Single pass parser for newick strings with leaf labels only (no branch lengths, internal labels, comments or
+    # quotes), building the compact tree directly. Nodes with more than two children are made binary as they are closed,
+    # in the same way as convertTreeIntoBinary. Returns None for anything outside this grammar, including malformed
+    # strings, which are then left to the ete3 parser
+    tokens = NEWICK_TOKENS.findall(x)
+    if not tokens or tokens[0] != "(":
+        return None
+    T = CompactTree()
+    stack, prev = [], None
+    for token in tokens:
+        if token == "(":
+            if prev not in [None, "(", ","]:
+                return None
+            stack.append([])
+        elif token == "," or token == ")":
+            if prev == "(" or prev == "," or not stack:
+                return None
+            if token == ")":
+                children = stack.pop()
+                # ((...((c0, c1), c2), ...), c[-2]), c[-1]
+                if len(children) > 2:
+                    v = children[0]
+                    for c in children[1:-1]:
+                        v, u = T.addNode(), v
+                        T.addChild(v, u)
+                        T.addChild(v, c)
+                    children = [v, children[-1]]
+                v = T.addNode()
+                for c in children:
+                    T.addChild(v, c)
+                if stack:
+                    stack[-1].append(v)
+                else:
+                    T.root = v
+        elif token == ";":
+            if prev != ")" or stack:
+                return None
+        else:
+            name = token.strip()
+            if not name:
+                continue
+            if (prev != "(" and prev != ",") or not NEWICK_LABEL.fullmatch(name):
+                return None
+            stack[-1].append(T.addNode(name))
+            prev = "label"
+            continue
+        prev = token
+    if prev != ";":
+        return None
+    T.reindex()
+    return T
+
+
+
+class InputTreeError(ValueError):
+    # Raised by readTrees for an input tree that cannot be compared
+    pass
+
+
+
+def readTree(x, index, cache=None):
+    # The tree of the newick string x, the non empty line index (from 0) of the input file, as a compact tree made binary
+    # Plain newick strings are read by parseNewick, any other string by ete3
+    # With a cache (see TreeCache), the tree is a reference tree, loaded from the cache if it is in it and cached otherwise
+    if cache:
+        R = cache.load(x)
+        if R is not None:
+            return R
+    T = parseNewick(x)
+    if T is None:
+        with profilePhase("parse"):
+            t = Tree(x)
+        # checking to see if give tree is binary or not
+        # with the new convertTreeIntoBinary, should no longer reach the error
+        convertTreeIntoBinary(t)
+        for node in t.traverse("preorder"):
+            if(len(node.children) > 2):
+                raise InputTreeError("non binary tree line: {}".format(index+1))
+        T = CompactTree(t)
+    return cache.save(x, T) if cache else T
+
+
+def newickLine(line):
+    # The newick string of a line of the input file, None for an empty line
+    x = line.strip(" \t\n")
+    if(x == ''):
+        return None
+    if(x[-1] != ";"):
+        x = x + ";"
+    return x
+
+
+def readTrees(path, cache=None):
+    # Generator over the trees of the input file (see readTree), one per non empty line, each parsed and made binary
+    # only when it is requested, so that the trees of a file never have to be in memory all at once.
+    index = 0
+    with openInput(path) as openbn:
+        for line in openbn:
+            x = newickLine(line)
+            if x is not None:
+                yield readTree(x, index, cache)
+                index += 1
 
 
+
+class TreeFile:
+    # Random access to the trees (non empty lines) of the input file, numbered from 0 as by readTrees.
+    # The byte offsets of the start and end of every non empty line are found by a scan of the memory mapped file (in
+    # vectorized chunks of whole lines), or read from the sidecar index file path + ".rfidx" written by an earlier run
+    # with save. The index file starts with the size and modification time of the input file, and is rebuilt whenever
+    # they change. Reading a tree then only parses its own line.
+    # Compressed files cannot be mapped: they are read in one pass, only the requested trees being parsed
+    INDEX_FORMAT = 1
+    CHUNK = 1 << 24
+
+    def __init__(self, path, cache=None, save=False):
+        self.path, self.cache = path, cache
+        self.starts = self.ends = None
+        if decompressor(path):
+            with openInput(path) as openbn:
+                self.count = sum(1 for line in openbn if newickLine(line) is not None)
+            return
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        info = os.stat(path)
+        header = [self.INDEX_FORMAT, info.st_size, info.st_mtime_ns]
+        indexPath = path + ".rfidx"
+        if os.path.exists(indexPath) and os.path.getsize(indexPath) >= 32:
+            index = np.memmap(indexPath, dtype = np.uint64, mode = "r")
+            if index[:3].tolist() == header:
+                self.count = int(index[3])
+                self.starts, self.ends = index[4:4 + self.count], index[4 + self.count:4 + 2 * self.count]
+                return
+        self.starts, self.ends = self.scan()
+        self.count = len(self.starts)
+        if save:
+            np.concatenate([header, [self.count], self.starts, self.ends]).astype(np.uint64).tofile(indexPath)
+
+    def scan(self):
+        starts, ends = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        pos, n = 0, len(self.data)
+        while pos < n:
+            # the chunk ends after a line break, unless the rest of the file fits in it
+            end = n
+            if pos + self.CHUNK < n:
+                end = self.data.rfind(b"\n", pos, pos + self.CHUNK) + 1
+                if end <= pos:
+                    end = self.data.find(b"\n", pos + self.CHUNK) + 1 or n
+            chunk = np.frombuffer(self.data, dtype=np.uint8, count = end - pos, offset = pos)
+            breaks = np.flatnonzero(chunk == ord("\n"))
+            first, last = np.concatenate([[0], breaks + 1]), np.append(breaks, len(chunk))
+            # a line is empty if there is no character other than spaces, tabs and line breaks before its end
+            text = np.flatnonzero(~np.isin(chunk, np.frombuffer(b" \t\r\n", dtype=np.uint8)))
+            k = np.searchsorted(text, first)
+            filled = np.zeros(len(first), dtype=bool)
+            filled[k < len(text)] = text[k[k < len(text)]] < last[k < len(text)]
+            starts.append(first[filled] + pos)
+            ends.append(last[filled] + pos)
+            pos = end
+        return np.concatenate(starts), np.concatenate(ends)
+
+    # Generator over the pairs (k, tree k) for the sorted tree numbers indices
+    def trees(self, indices):
+        if self.starts is None:
+            wanted, index = set(indices), 0
+            with openInput(self.path) as openbn:
+                for line in openbn:
+                    x = newickLine(line)
+                    if x is not None:
+                        if index in wanted:
+                            yield index, readTree(x, index, self.cache)
+                            wanted.discard(index)
+                            if not wanted:
+                                return
+                        index += 1
+            return
+        for k in indices:
+            x = newickLine(self.data[int(self.starts[k]):int(self.ends[k])].decode().replace("\r", ""))
+            yield k, readTree(x, k, self.cache)
+
+
+
+@profiled("binarize")
 def convertTreeIntoBinary(T):
     for node in T.traverse("postorder"):
         if ( not node.is_leaf() ):
@@ -1079,6 +1786,186 @@ def convertTreeIntoBinary(T):
 
 
 
+# Interned index of every leaf name seen by robinsonFoulds, so that leaves are identified by the same integer in all trees
+LEAF_INDEX = {}
+
+
+
+def forgetLeaves(count):
+    # Forget the leaf names interned after the first count names (LEAF_INDEX is in order of interning). The trees whose
+    # cluster index holds any of these names must not be compared again
+    while len(LEAF_INDEX) > count:
+        LEAF_INDEX.popitem()
+
+
+
+def leafHash(index):
+    # 64 bit hash of interned leaf indexes (splitmix64 finalizer). Clusters are hashed to the XOR of the hashes of their
+    # leaves, so two different clusters only get the same hash with probability about 2^-64
+    z = np.asarray(index, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+
+def treeSplits(T, kept, unrooted=False):
+    # Hashes of the clusters of the compact tree T restricted to the leaves kept (kept tells for every position of the
+    # postorder whether it is a kept leaf), or for unrooted trees of the bipartitions of the kept leaves induced by the
+    # edges of T.
+    # Every subtree is a contiguous run of the postorder, so all restricted clusters come from one prefix XOR (and one
+    # prefix sum, counting the kept leaves) along the postorder. A bipartition is represented by the smaller hash of its
+    # two sides, the hash of one side being the hash of the whole leaf set XOR the hash of the other side
+    leaves, start = T.clusterIndex()
+    hashes = np.zeros(len(leaves) + 1, dtype=np.uint64)
+    np.bitwise_xor.accumulate(np.where(kept, leafHash(leaves), np.uint64(0)), out=hashes[1:])
+    clusters = hashes[1:] ^ hashes[start]
+    if unrooted:
+        return np.unique(np.minimum(clusters, clusters ^ hashes[-1]))
+    counts = np.zeros(len(leaves) + 1, dtype=np.int64)
+    np.cumsum(kept, out=counts[1:])
+    return np.unique(clusters[counts[1:] > counts[start]])
+
+
+
+@profiled("rf")
+def robinsonFoulds(T1, T2, unrooted=False):
+    # Robinson-Foulds distance between T1 and T2 restricted to their shared leaves,
+    # same as T1.robinson_foulds(T2, unrooted_trees=unrooted)[0]
+    # Compact trees keep their cluster index between calls, ete3 trees (binary) are converted on every call
+    T1 = T1 if isinstance(T1, CompactTree) else CompactTree(T1)
+    T2 = T2 if isinstance(T2, CompactTree) else CompactTree(T2)
+    # the shared leaves are found from the interned leaves of both trees, so the time taken only depends on their sizes
+    leaves1, leaves2 = T1.clusterIndex()[0], T2.clusterIndex()[0]
+    kept1, kept2 = np.isin(leaves1, leaves2[leaves2 >= 0]), np.isin(leaves2, leaves1[leaves1 >= 0])
+    return len(np.setxor1d(treeSplits(T1, kept1, unrooted), treeSplits(T2, kept2, unrooted), assume_unique=True))
+
+
+
+# Result of comparePair: the numbers of leaves of both trees, the RF(-), RF(+) and EF-RF(+) distances, the sizes of the
+# union and intersection of the leaf sets, the newick strings of the completions, the times of the comparison and the
+# summary of its profile
+PairResult = collections.namedtuple("PairResult", ["leaves1", "leaves2", "rf", "rf_plus", "ef_rf_plus", "union",
+                                                   "intersection", "newick1", "newick2", "times", "summary"])
+
+
+
+def comparePair(T1, T2, lca="bfc", unrooted=False, extraneousfree=False, distanceOnly=False, profile=False):
+    # Compare one pair of trees (ete3, compact or reference trees) as reported by main(): returns a PairResult holding the
+    # numbers of leaves of both trees, the RF(-), RF(+) and EF-RF(+) distances, the sizes of the union and intersection of
+    # the leaf sets, and the newick strings of the requested completions (EF-RF(+) if extraneousfree, RF(+) otherwise;
+    # None if distanceOnly), and the wall clock and CPU times in seconds of the EF-RF(+) and RF(+) completions and of
+    # the whole comparison.
+    # With profile, the comparison is profiled on its own (see Profile) and the summary of its profile is also returned,
+    # the time not spent in any phase being counted as "other" and, if tracemalloc is tracing, the peak memory traced
+    # during the comparison as peak_memory (tracing memory slows down the phases allocating many objects, such as the DP)
+    global PROFILE
+    outer = PROFILE
+    if profile:
+        PROFILE = Profile()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        startNs = time.perf_counter_ns()
+    start, startCpu = time.time(), time.process_time()
+    inputs = [T.tree if isinstance(T, ReferenceTree) else T for T in [T1, T2]]
+    sizes = [T.leafCount[T.root] if isinstance(T, CompactTree) else len(T) for T in inputs]
+    a = robinsonFoulds(*inputs)
+    y = compareTree(T1, T2, lca)
+    z2, z1 = y.distances(unrooted)
+    union = y.RF1.leafCount[y.RF1.root]
+    intersection = union - len(y.yellowLeaves) - len(y.redLeaves)
+    newick = [None, None]
+    if not distanceOnly:
+        # distances() has computed the completions of both kinds as compact trees
+        completed = [y.EF1, y.EF2] if extraneousfree else [y.RF1, y.RF2]
+        newick = [T.newick() for T in completed]
+    times = (y.EF_time, y.EF_cpu, y.RF_time, y.RF_cpu, time.time() - start, time.process_time() - startCpu)
+    summary = None
+    if profile:
+        PROFILE.times["other"] = time.perf_counter_ns() - startNs - sum(PROFILE.times.values())
+        if tracemalloc.is_tracing():
+            PROFILE.peak = PROFILE.tracedPeak()
+        summary = PROFILE.summary()
+    PROFILE = outer
+    return PairResult(sizes[0], sizes[1], a, z2, z1, union, intersection, newick[0], newick[1], times, summary)
+
+
+
+# Trees and options of the comparisons run by a worker process of main() (see initWorker and compareChunk)
+workerTrees, workerOptions = None, None
+
+
+
+def initWorker(trees, options, trace=False):
+    global workerTrees, workerOptions
+    workerTrees, workerOptions = trees, options
+    if trace and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+
+def compareChunk(chunk):
+    # Compare the pairs (k, i, j) of chunk in a worker process, returning the results keyed by the position k of the pair
+    return [(k, comparePair(workerTrees[i], workerTrees[j], *workerOptions)) for k, i, j in chunk]
+
+
+
+def pairReport(i, j, result, printed):
+    # Text reported by main() for the pair of trees i, j. printed selects the layout of the terminal output, which has an
+    # extra empty line after each completed tree compared to the output file. Without completed trees (distance only
+    # mode) the distances are directly followed by the separator line
+    extra = "\n" if printed else ""
+    distances = ("Results for Tree {} and Tree {}\n".format(i+1, j+1) +
+            "Number of leaves in Tree {}: {}\n".format(i+1, result.leaves1) +
+            "Number of leaves in Tree {}: {}\n".format(j+1, result.leaves2) +
+            "Union of leaf sets: {}\n".format(result.union) +
+            "Intersection of leaf sets: {}\n".format(result.intersection) +
+            "RF(-) distance: {}\n".format(result.rf) +
+            "RF(+) distance: {}\n".format(result.rf_plus) +
+            "EF-RF(+) distance: {}\n".format(result.ef_rf_plus))
+    if result.newick1 is None:
+        return distances + "--------------------------------------------------------------------------------------------------------------------------\n\n"
+    return (distances +
+            "Completed trees:\n" +
+            result.newick1 + "\n\n" + extra +
+            result.newick2 + "\n\n--------------------------------------------------------------------------------------------------------------------------\n\n" + extra)
+
+
+
+# Columns of the analysis file of main(), one row per pair of trees (numbered from 1, in input order). Times are in
+# seconds: wall clock (time) and CPU (cpu) times of the EF-RF(+) completions, of the RF(+) completions (once the EF-RF(+)
+# completions are known), and of the whole comparison of the pair
+ANALYSIS_FIELDS = ["tree1", "tree2", "leaves1", "leaves2", "union", "intersection", "rf", "rf_plus", "ef_rf_plus",
+                   "ef_time", "ef_cpu", "rf_time", "rf_cpu", "total_time", "total_cpu"]
+
+
+class AnalysisWriter:
+    # Writes the analysis rows of main() as CSV, or as JSON lines if the file name ends in .jsonl (before any .gz, which
+    # compresses the file with gzip). Rows go through a large write buffer, so millions of pairs cost few system calls
+    def __init__(self, path):
+        name = path[:-3] if path.endswith(".gz") else path
+        self.jsonl = name.endswith(".jsonl")
+        if path.endswith(".gz"):
+            self.file = gzip.open(path, "wt", newline = "")
+        else:
+            self.file = open(path, "w", newline = "", buffering = 1 << 20)
+        if not self.jsonl:
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(ANALYSIS_FIELDS)
+
+    def write(self, i, j, result):
+        row = [i+1, j+1] + [getattr(result, name) for name in ANALYSIS_FIELDS[2:9]] + [round(x, 6) for x in result.times]
+        if self.jsonl:
+            self.file.write(json.dumps(dict(zip(ANALYSIS_FIELDS, row))) + "\n")
+        else:
+            self.csv.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+
+
 def main():
     # takes an input file (required)
     # -o output file to print to is optional. when not present, print to treminal
@@ -1087,98 +1974,407 @@ def main():
     parser.add_argument("-ext", "--extraneousfree", action="store_true", help = "This flag signifies computation of the EF-RF(+) completions rather than the more general RF(+) completions.")
     parser.add_argument("-u", "--unrooted", action="store_true", help = "This flag signifies that the input trees are unrooted.")
     parser.add_argument("-i", "--inputfile", type = str, help = "The input file contains the trees in newick format. This argument is required.")
-    parser.add_argument("-o", "--outputfile", type = str, help = "The output file to which the RF distance and completions in newick format will be printed")
-    #parser.add_argument("-r", "--rfdistance", action="store_true", help = "Type this command to print the RF(-), EF-RF(+) and RF(+) distances instead of the completed trees. If this flag is used, then the -ext flag is not necessary.")
-    #parser.add_argument("-a", "--analysisfile", type = str, help = "A csv file which will store every pair of trees, labeled by line number, along with the RF(-) and RF(+) distances, sizes of the intersection and union of input tree leaf sets, and runtime for EF-R-RF(+) and R-RF(+) completions. Note the recorded RF(+) runtime is the runtime to compute the RF(+) distance assuming the EF-RF(+) completions have already been computed.")
+    parser.add_argument("-o", "--outputfile", type = str, help = "The output file to which the RF distance and completions in newick format will be printed (compressed with gzip if its name ends in .gz)")
+    parser.add_argument("-l", "--lca", choices = ["bfc", "st"], default = "bfc", help = "The range minimum query structure used for LCA computation: bfc (linear preprocessing, the default) or st (sparse table, O(n log n) preprocessing).")
+    parser.add_argument("-j", "--jobs", type = int, default = 1, help = "The number of worker processes comparing pairs of trees in parallel (1 by default). Results are reported in input order.")
+    parser.add_argument("--chunk-size", type = int, default = 16, help = "The maximum number of pairs of trees sent to a worker process at once when --jobs is greater than 1.")
+    pairs = parser.add_mutually_exclusive_group()
+    pairs.add_argument("--all-pairs", action="store_true", help = "This flag signifies that every pair of input trees is compared, rather than the first tree with every other tree.")
+    pairs.add_argument("--pairs-file", type = str, help = "A file listing the pairs of input trees to compare, one pair per line given by the numbers of the two trees (starting from 1, in input order) separated by a space or a comma.")
+    parser.add_argument("--reference", type = int, help = "The number of the tree (starting from 1, in input order) compared with the other trees, instead of the first tree.")
+    parser.add_argument("--range", type = str, help = "Only compare the trees numbered from a to b (both included, starting from 1) given as a:b, either of which may be omitted. With --all-pairs, every pair of these trees is compared.")
+    parser.add_argument("--stride", type = int, help = "Only compare every s-th tree (of the range, if any). With --all-pairs, every pair of these trees is compared.")
+    parser.add_argument("--index", action="store_true", help = "Save the byte offsets of the trees of the input file in the sidecar file input.rfidx, from which later runs with --reference, --range, --stride or --pairs-file read them instead of scanning the input file. The index is rebuilt whenever the input file changes. Compressed input files cannot be indexed.")
+    parser.add_argument("--pipeline", action="store_true", help = "Compare the reference tree (the first tree, or the tree given by --reference) with the other trees in a pipeline: the trees are read in a thread of their own while earlier trees are compared in --jobs worker processes (at least one) and the results are written, with at most a few trees per worker process in memory. Not used with --all-pairs or --pairs-file.")
+    parser.add_argument("--serve", action="store_true", help = "Load the trees of the input file once and answer comparison requests, one JSON object per line, on the standard input (answering on the standard output) or on the Unix socket given by --socket, until the end of the input. See serveRequest for the format of the requests and answers.")
+    parser.add_argument("--socket", type = str, help = "The path of the Unix socket on which --serve listens.")
+    parser.add_argument("-r", "--rfdistance", action="store_true", help = "Type this command to print the RF(-), EF-RF(+) and RF(+) distances instead of the completed trees. If this flag is used, then the -ext flag is not necessary.")
+    parser.add_argument("--cache-dir", type = str, help = "A directory in which every input tree is cached once prepared (parsed, made binary, indexed and LCA preprocessed), in a binary file named by a hash of its newick string. Later runs load the trees found in the cache instead of preparing them again.")
+    parser.add_argument("--profile", action="store_true", help = "Print to the standard error, for every pair of trees and then in aggregate over the whole run, the time spent in each phase of the computation (parsing, binarization, coloring, LCA preprocessing and queries, grafting, reindexing, dynamic program, pairing of extraneous clades, RF computations and output) in nanoseconds, and counters of LCA queries, LCA mappings built, DP cells, grafts and pairings, as JSON lines.")
+    parser.add_argument("--profile-memory", action="store_true", help = "Same as --profile, also recording the peak memory traced by tracemalloc in bytes, overall and during each phase. Tracing memory slows the program down, unevenly across the phases, so the phase times are only meaningful without this option.")
+    parser.add_argument("--cprofile", type = str, help = "A file to which cProfile statistics of the whole run (of the main process only, when --jobs is greater than 1) are written, to be read with pstats.")
+    parser.add_argument("-a", "--analysisfile", type = str, help = "A file which will store one row for every pair of trees, labeled by their numbers in input order, along with the numbers of leaves of both trees, the sizes of the union and intersection of their leaf sets, the RF(-), RF(+) and EF-RF(+) distances, and the wall clock and CPU runtimes for the EF-R-RF(+) and R-RF(+) completions and the whole comparison. The file is written as CSV, or as JSON lines if its name ends in .jsonl, and is gzipped if its name ends in .gz. Note the recorded RF(+) runtime is the runtime to compute the RF(+) distance assuming the EF-RF(+) completions have already been computed.")
     args = parser.parse_args()
-    msn = []
-    index = 0
-    with open(args.inputfile) as openbn:
-        for line in openbn:
-            x = line.strip(' ').strip('\t').strip('\n').strip(' ').strip('\t').strip('\n').strip(' ').strip('\t').strip('\n')
-            if(x != ''):
-                if(x[-1] != ";"):
-                    x = x + ";"
-                t = Tree(x)
-                # checking to see if give tree is binary or not
-                # with the new convertTreeIntoBinary, should no longer reach the error
-                convertTreeIntoBinary(t)
-                for node in t.traverse("preorder"):
-                    if(len(node.children) > 2):
-                        print("Error - non binary tree line: {}\n".format(index+1))
-                        return
-                msn.append(t)
-                index += 1
-
+    args.profile = args.profile or args.profile_memory
+    if args.pairs_file and (args.reference is not None or args.range or args.stride is not None):
+        parser.error("--pairs-file cannot be combined with --reference, --range or --stride")
+    if args.index and args.inputfile and os.path.isfile(args.inputfile) and decompressor(args.inputfile):
+        parser.error("--index cannot be used with a compressed input file, whose trees are read in one pass")
+    if args.serve:
+        serve(args)
+        return
     if(args.outputfile):
         fileNameW = args.outputfile
-        fileW = open(fileNameW, "w")
-
-
-    i = 0
-    for j in range(i+1, len(msn)):
-        #print("I, J:\t", i, j)
-        #print("Length of tree {}:\t".format(j), len(msn[j]))
-
-
-        a = msn[i].robinson_foulds(msn[j])[0]
-        y = compareTree(msn[i], msn[j])
-        if args.unrooted:
-            y1 = y.EF_U_RF()
-            y2 = y.U_RF_Plus()
-            z1 = y1[0].robinson_foulds(y1[1], unrooted_trees=True)[0]
-            z2 = y2[0].robinson_foulds(y2[1], unrooted_trees=True)[0]
-        else:
-            y1 = y.EF_R_RF()
-            #y3 = compareTree(msn[1], msn[j])
-            y2 = y.R_RF_Plus()
-            z1 = y1[0].robinson_foulds(y1[1])[0]
-            z2 = y2[0].robinson_foulds(y2[1])[0]
-
-
-        if args.outputfile:
-            fileW.write("Results for Tree {} and Tree {}\n".format(i+1, j+1))
-            fileW.write("Number of leaves in Tree {}: {}\n".format(i+1, len(msn[i])))
-            fileW.write("Number of leaves in Tree {}: {}\n".format(j+1, len(msn[j])))
-            fileW.write("Union of leaf sets: {}\n".format(len(y2[0])))
-            fileW.write("Intersection of leaf sets: {}\n".format(len(y2[0]) - len(y.yellowLeaves) - len(y.redLeaves)))
-            fileW.write("RF(-) distance: {}\n".format(a))
-            fileW.write("RF(+) distance: {}\n".format(z2))
-            fileW.write("EF-RF(+) distance: {}\n".format(z1))
-            fileW.write("Completed trees:\n")
-
-            if args.extraneousfree:
-                fileW.write(y1[0].write(format = 9) + "\n\n")
-                #fileW.write("\n\n")
-                fileW.write(y1[1].write(format = 9) + "\n\n--------------------------------------------------------------------------------------------------------------------------\n\n")
-            else:
-                fileW.write(y2[0].write(format = 9) + "\n\n")
-                #fileW.write("\n\n")
-                fileW.write(y2[1].write(format = 9) + "\n\n--------------------------------------------------------------------------------------------------------------------------\n\n")
-
-        else:
-            print("Results for Tree {} and Tree {}".format(i+1, j+1))
-            print("Number of leaves in Tree {}: {}".format(i+1, len(msn[i])))
-            print("Number of leaves in Tree {}: {}".format(j+1, len(msn[j])))
-            print("Union of leaf sets: {}".format(len(y2[0])))
-            print("Intersection of leaf sets: {}".format(len(y2[0]) - len(y.yellowLeaves) - len(y.redLeaves)))
-            print("RF(-) distance: {}".format(a))
-            print("RF(+) distance: {}".format(z2))
-            print("EF-RF(+) distance: {}".format(z1))
-            print("Completed trees:")
-
-            if args.extraneousfree:
-                print(y1[0].write(format = 9) + "\n\n")
-                #print("\n\n")
-                print(y1[1].write(format = 9) + "\n\n--------------------------------------------------------------------------------------------------------------------------\n\n")
+        fileW = gzip.open(fileNameW, "wt") if fileNameW.endswith(".gz") else open(fileNameW, "w", buffering = 1 << 20)
+    else:
+        fileW = None
+    analysis = AnalysisWriter(args.analysisfile) if args.analysisfile else None
+
+    # With --profile, the main process records the phases done outside of the comparisons (reading the trees, writing
+    # the reports) in PROFILE, while the comparisons report their own profiles, added up in total. Memory is only traced
+    # with --profile-memory
+    global PROFILE
+    if args.profile:
+        PROFILE, total = Profile(), Profile()
+    if args.profile_memory:
+        tracemalloc.start()
+
+    def report(i, j, result):
+        with profilePhase("output"):
+            if fileW:
+                fileW.write(pairReport(i, j, result, False))
             else:
-                print(y2[0].write(format = 9) + "\n\n")
-                #print("\n\n")
-                print(y2[1].write(format = 9) + "\n\n--------------------------------------------------------------------------------------------------------------------------\n\n")
-
+                print(pairReport(i, j, result, True), end = "")
+            if analysis:
+                analysis.write(i, j, result)
+        summary = result.summary
+        if summary:
+            total.merge(summary)
+            print(json.dumps(dict({"tree1": i+1, "tree2": j+1}, **summary)), file = sys.stderr)
+
+    profiler = cProfile.Profile() if args.cprofile else None
+    try:
+        if profiler:
+            profiler.enable()
+        compareInput(args, report)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        if(args.outputfile):
+            fileW.close()
+        if analysis:
+            analysis.close()
+    if args.profile:
+        if args.profile_memory:
+            PROFILE.peak = PROFILE.tracedPeak()
+        total.merge(PROFILE.summary())
+        print(json.dumps(dict({"aggregate": True}, **total.summary())), file = sys.stderr)
+
+
+
+def readPairs(path, count):
+    # The pairs of trees listed in the file path (see --pairs-file), numbered from 0, None if a line is invalid
+    pairs = []
+    with open(path) as openpf:
+        for index, line in enumerate(openpf):
+            x = line.replace(",", " ").split()
+            if(x != []):
+                if(len(x) != 2 or not all(k.isdigit() and 1 <= int(k) <= count for k in x)):
+                    print("Error - invalid pair line: {}\n".format(index+1))
+                    return None
+                pairs.append((int(x[0]) - 1, int(x[1]) - 1))
+    return pairs
+
+
+
+def selectPairs(args, count):
+    # The pairs of trees requested by --pairs-file, or by --reference, --range and --stride (with --all-pairs or not),
+    # among count trees numbered from 0. None if the selection is invalid
+    if args.pairs_file:
+        return readPairs(args.pairs_file, count)
+    reference = (1 if args.reference is None else args.reference) - 1
+    if not 0 <= reference < count:
+        print("Error - invalid reference: {}\n".format(args.reference))
+        return None
+    first, last = 1, count
+    if args.range:
+        bounds = args.range.split(":")
+        if len(bounds) != 2 or not all(x.isdigit() or x == "" for x in bounds):
+            print("Error - invalid range: {}\n".format(args.range))
+            return None
+        first, last = int(bounds[0] or first), min(count, int(bounds[1] or last))
+    stride = 1 if args.stride is None else args.stride
+    if stride < 1:
+        print("Error - invalid stride: {}\n".format(args.stride))
+        return None
+    selected = range(max(first, 1) - 1, last, stride)
+    if args.all_pairs:
+        return list(itertools.combinations(selected, 2))
+    return [(reference, j) for j in selected if j != reference]
+
+
+
+def compareInput(args, report):
+    # Read the input trees and report the comparison of every requested pair with report(i, j, result)
+    options = (args.lca, args.unrooted, args.extraneousfree, args.rfdistance, args.profile)
+    compact = {}
+    cache = TreeCache(args.cache_dir, args.lca) if args.cache_dir else None
+    if args.pairs_file or args.reference is not None or args.range or args.stride is not None or args.index:
+        compareSelection(args, report, options, cache)
+        return
+    try:
+        trees = readTrees(args.inputfile, cache)
+
+        # Default mode: only the first tree is kept, every other tree is read, compared, reported and dropped in turn
+        if not args.all_pairs and (args.jobs <= 1 or args.pipeline):
+            numbered = enumerate(trees)
+            for j, T in itertools.islice(numbered, 1):
+                compact[0] = ReferenceTree(T) if isinstance(T, CompactTree) else T
+                compareStream(args, report, options, 0, compact[0], numbered)
+            return
 
-    if(args.outputfile):
-        fileW.close()
+        # Every tree is prepared only once, however many pairs it is part of
+        for k, T in enumerate(trees):
+            compact[k] = ReferenceTree(T) if isinstance(T, CompactTree) else T
+    except InputTreeError as e:
+        print("Error - {}\n".format(e))
+        return
+
+    # the pairs of trees to compare
+    if args.all_pairs:
+        pairs = list(itertools.combinations(range(len(compact)), 2))
+    else:
+        pairs = [(0, j) for j in range(1, len(compact))]
+    comparePairs(args, report, options, compact, pairs)
+
+
+
+def compareSelection(args, report, options, cache):
+    # Same as compareInput for a selection of pairs (see selectPairs), or for any pairs with --index: only the trees of
+    # the selected pairs are parsed, reading them straight from their lines (see TreeFile)
+    source = TreeFile(args.inputfile, cache, args.index)
+    pairs = selectPairs(args, source.count)
+    if pairs is None:
+        return
+    needed = sorted({k for pair in pairs for k in pair})
+    compact = {}
+    try:
+        # Without --all-pairs, only the reference tree is kept, the other trees are read, compared and dropped in turn
+        if not (args.all_pairs or args.pairs_file) and (args.jobs <= 1 or args.pipeline):
+            reference = (1 if args.reference is None else args.reference) - 1
+            for k, T in source.trees([reference]):
+                compact[k] = ReferenceTree(T) if isinstance(T, CompactTree) else T
+            compareStream(args, report, options, reference, compact[reference],
+                          source.trees([k for k in needed if k != reference]))
+            return
+        for k, T in source.trees(needed):
+            compact[k] = ReferenceTree(T) if isinstance(T, CompactTree) else T
+    except InputTreeError as e:
+        print("Error - {}\n".format(e))
+        return
+    comparePairs(args, report, options, compact, pairs)
+
+
+
+def compareStream(args, report, options, reference, R, trees):
+    # Compare the reference tree R, numbered reference, with every tree T of the pairs (j, T) of the iterator trees, and
+    # report the results in order. Only R and the trees being compared are kept in memory
+    if args.pipeline:
+        asyncio.run(comparePipeline(args, report, options, reference, R, trees))
+        return
+    for j, T in trees:
+        report(reference, j, comparePair(R, T, *options))
+
+
+
+def compareWithReference(i, T):
+    # Compare the tree T with the tree i of a worker process (see initWorker)
+    return comparePair(workerTrees[i], T, *workerOptions)
+
+
+# Number of trees waiting in each queue of comparePipeline, per worker process
+PIPELINE_DEPTH = 4
+
+
+async def comparePipeline(args, report, options, reference, R, trees):
+    # compareStream as a pipeline of three stages running at the same time (--pipeline):
+    #   - read:    the trees are read and parsed in a thread of their own
+    #   - compute: every tree is compared with R in one of args.jobs worker processes (at least one), which hold R
+    #   - write:   the results are reported in order, every result already computed being reported in the same batch
+    # The stages are linked by bounded queues, so that reading waits when the comparisons fall behind, and at most a few
+    # trees per worker process are in memory at any time. An error in reading a tree is raised by the write stage, after
+    # reporting the trees before it, as compareStream does
+    loop = asyncio.get_running_loop()
+    workers = max(1, args.jobs)
+    parsed, computing = asyncio.Queue(PIPELINE_DEPTH * workers), asyncio.Queue(PIPELINE_DEPTH * workers)
+
+    async def read():
+        with ThreadPoolExecutor(max_workers = 1) as reader:
+            while True:
+                try:
+                    item = await loop.run_in_executor(reader, next, trees, None)
+                except Exception as e:
+                    item = e
+                await parsed.put(item)
+                if item is None or isinstance(item, Exception):
+                    return
+
+    async def compute(executor):
+        while True:
+            item = await parsed.get()
+            if item is None or isinstance(item, Exception):
+                await computing.put(item)
+                return
+            j, T = item
+            await computing.put((j, loop.run_in_executor(executor, compareWithReference, reference, T)))
+
+    async def write():
+        while True:
+            batch = [await computing.get()]
+            while not computing.empty():
+                batch.append(computing.get_nowait())
+            for item in batch:
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                j, future = item
+                report(reference, j, await future)
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = initWorker,
+                             initargs = ({reference: R}, options, args.profile_memory)) as executor:
+        await asyncio.gather(read(), compute(executor), write())
+
+
+
+# Number of chunks of pairs running or queued in the worker processes of comparePairs, per worker process
+CHUNKS_IN_FLIGHT = 4
+
+
+
+def pairChunks(pairs, union, start, window, chunkSize):
+    # Chunks of comparePairs for the window of pairs start, ..., start + window - 1: the pairs (k, i, j) of the window,
+    # largest first (by union(k), the size of the union of their leaf sets), in chunks of chunkSize pairs
+    order = sorted(range(start, min(start + window, len(pairs))), key = lambda k: -union(k))
+    return [[(k, pairs[k][0], pairs[k][1]) for k in order[x:x + chunkSize]] for x in range(0, len(order), chunkSize)]
+
+
+
+def comparePairs(args, report, options, compact, pairs):
+    # Compare and report the pairs of the prepared trees compact, serially or with args.jobs worker processes
+    results = {}
+    if args.jobs <= 1:
+        for i, j in pairs:
+            report(i, j, comparePair(compact[i], compact[j], *options))
+    else:
+        # The pairs are dispatched by windows of consecutive pairs, the largest pairs of a window first, in chunks of pairs
+        # of similar sizes, so that no large pair of the window is left for the end. At most CHUNKS_IN_FLIGHT chunks per
+        # worker process are submitted at once, and a window is only dispatched once the pairs before the previous window
+        # have all been reported. Results are reported in input order as soon as all the pairs before them are done, so
+        # at most two windows of results are ever waiting, however many pairs there are
+        union = lambda k: len(compact[pairs[k][0]].tree.leafId.keys() | compact[pairs[k][1]].tree.leafId.keys())
+        chunkSize = max(1, min(args.chunk_size, len(pairs) // (4 * args.jobs)))
+        inFlight = CHUNKS_IN_FLIGHT * args.jobs
+        window = inFlight * chunkSize
+        with ProcessPoolExecutor(max_workers = args.jobs, initializer = initWorker, initargs = (compact, options, args.profile_memory)) as executor:
+            running, waiting, nextWindow, nextPair = set(), [], 0, 0
+            while nextPair < len(pairs):
+                if not waiting and nextWindow < len(pairs) and nextWindow - window <= nextPair:
+                    waiting = pairChunks(pairs, union, nextWindow, window, chunkSize)[::-1]
+                    nextWindow = nextWindow + window
+                while waiting and len(running) < inFlight:
+                    running.add(executor.submit(compareChunk, waiting.pop()))
+                done, running = wait(running, return_when = FIRST_COMPLETED)
+                for future in done:
+                    results.update(future.result())
+                while nextPair in results:
+                    report(*pairs[nextPair], results.pop(nextPair))
+                    nextPair += 1
+
+
+
+def serveRequest(trees, args, line):
+    # Answer of the server (see serve) to a request, as a dictionary. A request is a JSON object such as
+    #     {"id": 1, "trees": [1, 5], "unrooted": false, "extraneousfree": false, "completions": true}
+    # where "trees" gives the two trees to compare, each either by its number in the input file (starting from 1) or as
+    # a newick string. The other keys are optional: "id" is copied into the answer, and "unrooted", "extraneousfree" and
+    # "completions", which must be JSON booleans, default to -u, -ext and the absence of -r. The answer holds the numbers
+    # of leaves of both trees ("leaves"), the sizes of the union and intersection of their leaf sets, the RF(-), RF(+)
+    # and EF-RF(+) distances ("rf", "rf_plus", "ef_rf_plus"), the two completed trees in newick format if requested
+    # ("completions"), and the time taken to answer in milliseconds ("latency_ms"), or an error message ("error")
+    start = time.perf_counter()
+    answer = {}
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("a request must be a JSON object")
+        if "id" in request:
+            answer["id"] = request["id"]
+        pair = request.get("trees")
+        if not isinstance(pair, list) or len(pair) != 2:
+            raise ValueError("trees must list two trees")
+        flags = {"unrooted": args.unrooted, "extraneousfree": args.extraneousfree, "completions": not args.rfdistance}
+        for key in flags:
+            if key in request:
+                if not isinstance(request[key], bool):
+                    raise ValueError("{} must be true or false".format(key))
+                flags[key] = request[key]
+        unrooted, extraneousfree, completions = flags["unrooted"], flags["extraneousfree"], flags["completions"]
+        # The leaf names of the trees given as newick strings are forgotten once the request is answered, so that they
+        # do not pile up in LEAF_INDEX over the life of the server. The names of the trees of the input file were all
+        # interned when they were prepared (see ReferenceTree)
+        interned = len(LEAF_INDEX)
+        try:
+            inputs = []
+            for x in pair:
+                if isinstance(x, str) and newickLine(x) is not None:
+                    T = readTree(newickLine(x), 0)
+                    inputs.append(ReferenceTree(T) if isinstance(T, CompactTree) else T)
+                elif isinstance(x, int) and not isinstance(x, bool) and 1 <= x <= len(trees):
+                    inputs.append(trees[x - 1])
+                else:
+                    raise ValueError("invalid tree: {}".format(x))
+            result = comparePair(inputs[0], inputs[1], args.lca, unrooted, extraneousfree, not completions)
+        finally:
+            forgetLeaves(interned)
+        answer.update({"leaves": [result.leaves1, result.leaves2], "union": result.union,
+                       "intersection": result.intersection, "rf": result.rf, "rf_plus": result.rf_plus,
+                       "ef_rf_plus": result.ef_rf_plus})
+        if completions:
+            answer["completions"] = [result.newick1, result.newick2]
+    # the server outlives any request it cannot answer
+    except Exception as e:
+        answer["error"] = "{}: {}".format(type(e).__name__, e)
+    answer["latency_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return answer
+
+
+
+def serve(args):
+    # Server mode of main() (--serve): the trees of the input file are read and prepared once (see ReferenceTree), and
+    # kept with their LCA mappings for every request, answered in order (see serveRequest)
+    try:
+        trees = []
+        for T in readTrees(args.inputfile, TreeCache(args.cache_dir, args.lca) if args.cache_dir else None):
+            trees.append(ReferenceTree(T) if isinstance(T, CompactTree) else T)
+    except InputTreeError as e:
+        print("Error - {}\n".format(e))
+        return
+
+    def answer(lines, write):
+        for line in lines:
+            if line.strip():
+                write(json.dumps(serveRequest(trees, args, line)) + "\n")
+
+    if not args.socket:
+        def write(text):
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        answer(sys.stdin, write)
+        return
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            answer((line.decode() for line in self.rfile), lambda text: self.wfile.write(text.encode()))
+
+    # connections are served one at a time, so that requests never run concurrently. A socket left at the path by an
+    # earlier server is replaced, anything else is left alone. The socket file is removed when the server is interrupted
+    # or terminated
+    if os.path.lexists(args.socket):
+        if not stat.S_ISSOCK(os.lstat(args.socket).st_mode):
+            print("Error - not a socket: {}\n".format(args.socket))
+            return
+        os.remove(args.socket)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with socketserver.UnixStreamServer(args.socket, Handler) as server:
+        print("Serving {} trees on {}".format(len(trees), args.socket), file = sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.socket)
 
 
 
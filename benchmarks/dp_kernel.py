@@ -0,0 +1,122 @@
+import argparse
+import importlib.util
+import math
+import os
+import time
+import numpy as np
+
+
+
+# Benchmark of the min-plus combination used by the RF(+) DP (minPlusSum, minPlusShift in RF+.py) against the recurrence
+# it replaced, which scans the candidates of every N one at a time. Both do Theta(a * b) element-wise work to combine
+# cost vectors of lengths a + 1 and b + 1: the kernels only replace the a * b interpreted steps of the recurrence by
+# min(a, b) + 1 vectorized steps over the longer vector. On caterpillars, where one child is always small, this removes
+# the interpreter overhead but the work summed over the tree, like the size of the DP tables, stays quadratic in the
+# number of extraneous clades.
+#
+#     python3 benchmarks/dp_kernel.py
+#     python3 benchmarks/dp_kernel.py --sizes 1000 10000 100000 --small 1 4 --repeat 5
+
+
+
+def loadRFPlus():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "RF+.py")
+    spec = importlib.util.spec_from_file_location("rfplus", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+
+def costVector(length, rng):
+    # Cost vectors of the DP are non-decreasing in N, mostly with steps of 1
+    return np.concatenate([[rng.integers(-3, 3)], rng.choice([0, 1, 1, 1, 2], size=length - 1)]).cumsum().astype(float)
+
+
+
+def recurrenceSum(A, B):
+    # Reference: the recurrence of the RF(+) DP for cL == cR == c as it was written before the min-plus kernels, one
+    # scalar candidate at a time: the splits NL + NR = N of each of its four ranges of N are scanned in its order, keeping
+    # the first minimum
+    A, B = A.tolist(), B.tolist()
+    a, b = len(A) - 1, len(B) - 1
+    C, NL = [math.inf] * (a + b + 1), [0] * (a + b + 1)
+    for N in range(a + b + 1):
+        if N <= min(a, b):
+            splits = [(n, N - n) for n in range(N + 1)]
+        elif N <= a:
+            splits = [(N - n, n) for n in range(b + 1)]
+        elif N <= b:
+            splits = [(n, N - n) for n in range(a + 1)]
+        else:
+            splits = [(a - n, N - a + n) for n in range(a + b - N + 1)]
+        for left, right in splits:
+            temp = A[left] + B[right]
+            if temp < C[N]:
+                C[N], NL[N] = temp, left
+    return np.array(C), np.array(NL, dtype=np.int64)
+
+
+
+def recurrenceShift(A, B):
+    # Reference: the recurrence for cL == c != cR as it was written before the min-plus kernels, scanning the number n of
+    # paired subtrees in increasing order, one scalar candidate at a time, keeping the first minimum
+    A, B = A.tolist(), B.tolist()
+    a, b = len(A) - 1, len(B) - 1
+    C, arg = [math.inf] * (a + 1), [0] * (a + 1)
+    for N in range(a + 1):
+        for n in range(min(a - N, b) + 1):
+            temp = A[N + n] + B[n] - n
+            if temp < C[N]:
+                C[N], arg[N] = temp, n
+    return np.array(C), np.array(arg, dtype=np.int64)
+
+
+
+def timed(function, repeat, *args):
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the min-plus combination of the RF(+) DP")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000],
+                        help="lengths of the larger cost vector")
+    parser.add_argument("--small", type=int, nargs="+", default=[1, 16],
+                        help="lengths of the smaller cost vector (use a value above the sizes for balanced children)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-scan", type=int, default=10000,
+                        help="skip the reference recurrence above this size")
+    args = parser.parse_args()
+
+    rf = loadRFPlus()
+    rng = np.random.default_rng(args.seed)
+
+    print("%-6s %10s %8s %14s %12s %8s" % ("kernel", "large", "small", "recurrence (s)", "min-plus (s)", "speedup"))
+    for large in args.sizes:
+        for small in args.small:
+            small = min(small, large)
+            A, B = costVector(large + 1, rng), costVector(small + 1, rng)
+            for name, scan, minPlus in [("sum", recurrenceSum, rf.minPlusSum),
+                                        ("shift", recurrenceShift, rf.minPlusShift)]:
+                t2, result = timed(minPlus, args.repeat, A, B)
+                if large <= args.max_scan:
+                    t1, expected = timed(scan, 1, A, B)
+                    if name == "sum":
+                        b = len(B) - 1
+                        result = (result[0], np.where(np.arange(len(result[0])) <= b, result[1], result[2]))
+                    assert all(np.array_equal(x, y) for x, y in zip(result, expected)), "kernels disagree"
+                    print("%-6s %10d %8d %14.4f %12.4f %8.1f" % (name, large, small, t1, t2, t1 / t2))
+                else:
+                    print("%-6s %10d %8d %14s %12.4f %8s" % (name, large, small, "-", t2, "-"))
+
+
+
+if __name__ == "__main__":
+    main()
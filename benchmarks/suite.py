@@ -0,0 +1,190 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from dp_kernel import loadRFPlus
+
+
+
+# Benchmark suite of RF+ over synthetic pairs of trees. Pairs of random binary trees are generated with a fixed seed for
+# every shape, number of leaves and leaf overlap, and compared in rooted and unrooted (-u) modes. The time of every
+# phase (see Profile in RF+.py), the counters of the work done and the peak memory traced by tracemalloc, overall and
+# during every phase, are written for every pair to a JSON file which can be compared with the results of another
+# version. Tracing memory slows RF+ down, so the peak memory is measured by a second comparison of the pair. Pairs on which RF+ fails are recorded with the
+# error instead of the measures.
+# Shapes:
+#     yule        - Yule (pure birth) trees: a uniformly chosen leaf is split in two at every step
+#     uniform     - uniform rooted binary trees: every leaf is added on a uniformly chosen edge (or above the root)
+#     caterpillar - every internal node has a leaf child, the deepest possible trees, which also check that RF+ handles
+#                   trees of any depth without recursion
+# The overlap is the fraction of the leaves of each tree that are also leaves of the other tree.
+#
+#     python3 benchmarks/suite.py --output results.json
+#     python3 benchmarks/suite.py --sizes 1000 10000 --shapes caterpillar --baseline results.json
+# The default sweep goes up to 10^6 leaves and takes hours: the DP tables of caterpillars with a small overlap grow with
+# the square of the number of leaves (see the "dp cells" counter). Use --sizes and --shapes to restrict it.
+
+
+
+SHAPES = ["yule", "uniform", "caterpillar"]
+
+
+
+def yule(n, rng):
+    # returns the parent of every node of a tree with n leaves, the root having parent -1, and the ids of its leaves
+    parent, leaves = [-1], [0]
+    for _ in range(n - 1):
+        k = rng.integers(len(leaves))
+        v = leaves[k]
+        leaves[k] = len(parent)
+        leaves.append(len(parent) + 1)
+        parent.extend([v, v])
+    return parent, leaves
+
+
+def uniform(n, rng):
+    parent, leaves, root = [-1], [0], 0
+    for _ in range(n - 1):
+        # the new leaf and a new internal node are put on the edge above v
+        v = int(rng.integers(len(parent)))
+        u, leaf = len(parent), len(parent) + 1
+        parent.extend([parent[v], u])
+        if v == root:
+            root = u
+        parent[v] = u
+        leaves.append(leaf)
+    return parent, leaves
+
+
+def caterpillar(n, rng):
+    parent, leaves, spine = [-1], [], 0
+    for _ in range(n - 1):
+        parent.extend([spine, spine])
+        leaves.append(len(parent) - 2)
+        spine = len(parent) - 1
+    leaves.append(spine)
+    return parent, leaves
+
+
+def newick(parent, leaves, names):
+    # newick string of the tree, the leaves being named by names (in the order of leaves)
+    children = [[] for _ in parent]
+    root = -1
+    for v, p in enumerate(parent):
+        if p == -1:
+            root = v
+        else:
+            children[p].append(v)
+    label = dict(zip(leaves, names))
+    out, stack = [], [(root, 0)]
+    while stack:
+        v, k = stack.pop()
+        if not children[v]:
+            out.append(label[v])
+        elif k < len(children[v]):
+            out.append("(" if k == 0 else ",")
+            stack.append((v, k + 1))
+            stack.append((children[v][k], 0))
+        else:
+            out.append(")")
+    return "".join(out) + ";"
+
+
+def treePair(shape, n, overlap, rng):
+    # two trees of the given shape with n leaves each, sharing round(overlap * n) leaves (at least 2)
+    shared = min(n, max(2, int(round(overlap * n))))
+    names1 = ["L%d" % i for i in range(n)]
+    names2 = names1[:shared] + ["L%d" % i for i in range(n, 2 * n - shared)]
+    generate = globals()[shape]
+    trees = []
+    for names in [names1, names2]:
+        parent, leaves = generate(n, rng)
+        trees.append(newick(parent, leaves, list(rng.permutation(names))))
+    return trees
+
+
+
+def run(rf, shape, n, overlap, unrooted, seed, memory=True):
+    rng = np.random.default_rng([seed, SHAPES.index(shape), n, int(overlap * 10000)])
+    x1, x2 = treePair(shape, n, overlap, rng)
+    result = {"shape": shape, "leaves": n, "overlap": overlap, "unrooted": unrooted, "seed": seed}
+    start = time.perf_counter_ns()
+    T1, T2 = rf.parseNewick(x1), rf.parseNewick(x2)
+    parse = time.perf_counter_ns() - start
+    try:
+        start = time.perf_counter_ns()
+        pair = rf.comparePair(rf.ReferenceTree(T1), T2, unrooted = unrooted, distanceOnly = True, profile = True)
+        summary = pair.summary
+        total = time.perf_counter_ns() - start
+        if memory:
+            tracemalloc.start()
+            traced = rf.comparePair(rf.ReferenceTree(T1), T2, unrooted = unrooted, distanceOnly = True,
+                                    profile = True).summary
+            summary["peak_memory"], summary["phase_peak_memory"] = traced["peak_memory"], traced["phase_peak_memory"]
+    except Exception as e:
+        result["error"] = repr(e)
+        return result
+    finally:
+        tracemalloc.stop()
+    summary["phases"]["parse"] = parse
+    result.update({"union": pair.union, "intersection": pair.intersection, "rf": pair.rf, "rf_plus": pair.rf_plus,
+                   "ef_rf_plus": pair.ef_rf_plus, "total_ns": total})
+    result.update(summary)
+    return result
+
+
+def key(result):
+    return (result["shape"], result["leaves"], result["overlap"], result["unrooted"], result["seed"])
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RF+ over synthetic pairs of trees")
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=SHAPES)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000, 1000000],
+                        help="numbers of leaves of each tree")
+    parser.add_argument("--overlaps", type=float, nargs="+", default=[0.01, 0.1, 0.5, 0.9, 1.0],
+                        help="fractions of the leaves of each tree shared with the other tree")
+    parser.add_argument("--modes", nargs="+", choices=["rooted", "unrooted"], default=["rooted", "unrooted"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip the measure of the peak memory")
+    parser.add_argument("--output", type=str, help="JSON file receiving the results")
+    parser.add_argument("--baseline", type=str, help="JSON results of another run, to print the speedup of every pair")
+    args = parser.parse_args()
+
+    rf = loadRFPlus()
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {key(result): result for result in json.load(f)["results"]}
+
+    results = []
+    print("%-12s %8s %8s %9s %12s %12s %9s" % ("shape", "leaves", "overlap", "mode", "time (s)", "peak (MB)", "speedup"))
+    for shape in args.shapes:
+        for n in args.sizes:
+            for overlap in args.overlaps:
+                for mode in args.modes:
+                    result = run(rf, shape, n, overlap, mode == "unrooted", args.seed, not args.no_memory)
+                    results.append(result)
+                    if "error" in result:
+                        print("%-12s %8d %8.2f %9s   %s" % (shape, n, overlap, mode, result["error"]))
+                        continue
+                    old = baseline.get(key(result))
+                    speedup = "%9s" % "-"
+                    if old and "error" not in old:
+                        speedup = "%9.2f" % (old["total_ns"] / result["total_ns"])
+                    print("%-12s %8d %8.2f %9s %12.4f %12.1f %s" % (shape, n, overlap, mode, result["total_ns"] / 1e9,
+                                                                   result.get("peak_memory", 0) / 1e6, speedup))
+                    sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__, "results": results}, f, indent = 1)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import importlib.util
+import os
+import subprocess
+import sys
+import pytest
+
+
+
+# RF+.py is a script rather than an importable module, so it is loaded from its path once for all the tests
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+SCRIPT = os.path.join(ROOT, "RF+.py")
+
+
+
+def loadRFPlus():
+    spec = importlib.util.spec_from_file_location("rfplus", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    # registered so that its classes can be pickled
+    sys.modules["rfplus"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+RF = loadRFPlus()
+
+
+@pytest.fixture
+def rf():
+    return RF
+
+
+@pytest.fixture
+def runRF():
+    # Run RF+.py with the given command line arguments, returning its standard output (or standard error, with
+    # stream="stderr")
+    def run(*args, stream="stdout", **kwargs):
+        process = subprocess.run([sys.executable, SCRIPT] + [str(x) for x in args], check=True, capture_output=True,
+                                 text=True, **kwargs)
+        return getattr(process, stream)
+    return run
+
+
+
+# Tests marked slow (such as trees with 10^6 leaves) only run with --runslow
+def pytest_addoption(parser):
+    parser.addoption("--runslow", action="store_true", help="also run the tests marked slow")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: takes minutes, only run with --runslow")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--runslow"):
+        return
+    skip = pytest.mark.skip(reason="slow, use --runslow")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip)
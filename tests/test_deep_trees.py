@@ -0,0 +1,47 @@
+import sys
+import pytest
+
+
+
+# Every traversal of RF+ uses an explicit stack, so caterpillars deeper than the recursion limit are compared without
+# raising it. The comparisons run at the default recursion limit
+
+
+
+def caterpillar(names):
+    # newick string of the caterpillar (((a, b), c), d)... over names, as deep as the number of names
+    return "(" * (len(names) - 1) + names[0] + "".join("," + x + ")" for x in names[1:]) + ";"
+
+
+def comparePair(rf, n, overlap, unrooted):
+    # Compare two caterpillars of n leaves sharing the first overlap leaves of the first tree
+    first = ["a{}".format(k) for k in range(n)]
+    second = first[:overlap] + ["b{}".format(k) for k in range(n - overlap)]
+    T1, T2 = rf.parseNewick(caterpillar(first)), rf.parseNewick(caterpillar(second))
+    assert T1 is not None and T2 is not None
+    return rf.comparePair(rf.ReferenceTree(T1), T2, unrooted=unrooted, distanceOnly=True)
+
+
+@pytest.mark.parametrize("unrooted", [False, True])
+def test_caterpillar_deeper_than_recursion_limit(rf, unrooted):
+    n = 2 * sys.getrecursionlimit()
+    size1, size2, a, z2, z1 = comparePair(rf, n, n // 2, unrooted)[:5]
+    assert (size1, size2) == (n, n)
+    # both caterpillars restricted to the shared leaves are the same caterpillar
+    assert a == 0
+    assert 0 <= z2 <= z1
+
+
+@pytest.mark.parametrize("unrooted", [False, True])
+def test_caterpillar_full_overlap_deeper_than_recursion_limit(rf, unrooted):
+    n = 2 * sys.getrecursionlimit()
+    result = comparePair(rf, n, n, unrooted)
+    assert result[:5] == (n, n, 0, 0, 0)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("unrooted", [False, True])
+def test_caterpillar_million_leaves(rf, unrooted):
+    n = 10 ** 6
+    result = comparePair(rf, n, n, unrooted)
+    assert result[:5] == (n, n, 0, 0, 0)
@@ -0,0 +1,26 @@
+import os
+import pytest
+
+
+
+# Output files of the original RF+ release (RF+.py of the first commit of the repository) on:
+#     marsupial      - MarsupialSubset.newick
+#     random         - data/random.newick, seeded random binary trees over partially overlapping subsets of 60 leaves
+#     multifurcating - data/multifurcating.newick, seeded random trees with multifurcations and some branch lengths
+# in each mode below, stored as data/<input>.<mode>.txt. The output of the current program must be byte for byte the
+# same: the completions depend on the order in which the DP breaks ties and extraneous clades are paired
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+INPUTS = {"marsupial": os.path.join(DATA, os.pardir, os.pardir, "MarsupialSubset.newick"),
+          "random": os.path.join(DATA, "random.newick"),
+          "multifurcating": os.path.join(DATA, "multifurcating.newick")}
+MODES = {"rooted": [], "unrooted": ["-u"], "ext": ["-ext"], "unrooted_ext": ["-u", "-ext"]}
+
+
+
+@pytest.mark.parametrize("mode", sorted(MODES))
+@pytest.mark.parametrize("name", sorted(INPUTS))
+def test_same_output_as_original(runRF, tmp_path, name, mode):
+    output = tmp_path / "output.txt"
+    runRF("-i", INPUTS[name], "-o", output, *MODES[mode])
+    with open(os.path.join(DATA, "{}.{}.txt".format(name, mode)), "rb") as f:
+        assert output.read_bytes() == f.read()
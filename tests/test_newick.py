@@ -0,0 +1,68 @@
+import random
+import pytest
+from ete3.coretype.tree import TreeError
+from test_robinson_foulds import randomTree
+
+
+
+# CompactTree.newick() must write the same text as ete3's write(format=9) of the tree converted back to ete3
+NAMES = ["a", "b", "with space", "colon:1", "semi;colon", "(paren)", "com,ma", "[comment]", "tab\there", "eq=ual",
+         "'single'", '"double"', "new\nline", "", None, "0.5", "ünïcode"]
+
+
+
+def compactTree(rf, names, rng):
+    # random rooted binary compact tree with the given leaf names (None for an unnamed leaf)
+    T = rf.CompactTree()
+    subtrees = [T.addNode(x) for x in names]
+    while len(subtrees) > 1:
+        i, j = sorted(rng.sample(range(len(subtrees)), 2))
+        v = T.addNode()
+        T.addChild(v, subtrees[i])
+        T.addChild(v, subtrees[j])
+        subtrees[j] = subtrees[-1]
+        subtrees.pop()
+        subtrees[i] = v
+    T.root = subtrees[0]
+    T.reindex()
+    return T
+
+
+@pytest.mark.parametrize("unrooted", [False, True])
+@pytest.mark.parametrize("seed", range(20))
+def test_same_as_ete3(rf, seed, unrooted):
+    rng = random.Random(seed)
+    T = compactTree(rf, rng.sample(NAMES, rng.randint(3, len(NAMES))), rng)
+    T.unrooted = unrooted
+    assert T.newick() == T.toEte().write(format=9)
+
+
+@pytest.mark.parametrize("unrooted", [False, True])
+@pytest.mark.parametrize("x", ["((a,b),c);", "(a,(b,c));", "((a,b),(c,d));", "(((a,b),c),d);"])
+def test_parsed_trees(rf, x, unrooted):
+    T = rf.parseNewick(x)
+    T.unrooted = unrooted
+    assert T.newick() == T.toEte().write(format=9)
+
+
+@pytest.mark.parametrize("unrooted", [False, True])
+@pytest.mark.parametrize("n", [3000, 20000])
+def test_large_trees(rf, n, unrooted):
+    # caterpillars deeper than the recursion limit, and random trees written in more than one chunk of the buffer
+    rng = random.Random(n)
+    for x in ["(" * (n - 1) + "l0" + "".join(",l{})".format(k) for k in range(1, n)) + ";",
+              randomTree(["l{}".format(k) for k in range(n)], rng)]:
+        T = rf.parseNewick(x)
+        T.unrooted = unrooted
+        assert T.newick() == T.toEte().write(format=9)
+        if not unrooted:
+            assert T.newick() == x
+
+
+def test_unroot_two_leaves(rf):
+    T = rf.parseNewick("(a,b);")
+    T.unrooted = True
+    with pytest.raises(TreeError):
+        T.toEte()
+    with pytest.raises(TreeError):
+        T.newick()
@@ -0,0 +1,98 @@
+import argparse
+import concurrent.futures
+import itertools
+import json
+import pickle
+import random
+import pytest
+from test_robinson_foulds import randomTree
+
+
+
+@pytest.fixture
+def inputfile(tmp_path):
+    # trees over random subsets of a pool of leaves, so that later trees bring leaf names not seen before
+    rng = random.Random(3)
+    pool = ["L{}".format(k) for k in range(120)]
+    path = tmp_path / "trees.newick"
+    path.write_text("".join(randomTree(rng.sample(pool, rng.randint(20, 70)), rng) + "\n" for _ in range(8)))
+    return path
+
+
+@pytest.mark.parametrize("options", [["--pipeline", "-j", "2"], ["--pipeline", "-j", "1"], ["-j", "2"],
+                                     ["--all-pairs", "-j", "2"]])
+def test_same_as_serial_with_cache(runRF, inputfile, tmp_path, options):
+    all_pairs = ["--all-pairs"] if "--all-pairs" in options else []
+    expected = runRF("-i", inputfile, "-r", *all_pairs)
+    # with a cold cache, then with a warm one
+    for _ in range(2):
+        assert runRF("-i", inputfile, "-r", "--cache-dir", tmp_path / "cache", *options) == expected
+    assert runRF("-i", inputfile, "-r", *options) == expected
+
+
+def test_pickled_tree_reinterns_leaves(rf, monkeypatch):
+    rng = random.Random(4)
+    names = ["n{}".format(k) for k in range(40)]
+    x, y = randomTree(names[:30], rng), randomTree(names[10:], rng)
+    expected = rf.robinsonFoulds(rf.parseNewick(x), rf.parseNewick(y))
+    data = pickle.dumps(rf.ReferenceTree(rf.parseNewick(x)))
+    # a worker process which has interned the leaf names in another order
+    rng.shuffle(names)
+    monkeypatch.setattr(rf, "LEAF_INDEX", {name: k for k, name in enumerate(names)})
+    assert rf.robinsonFoulds(pickle.loads(data).tree, rf.parseNewick(y)) == expected
+
+
+class InlineExecutor:
+    # Stand-in for ProcessPoolExecutor running every submitted chunk at once in this process, counting the pairs
+    # submitted
+    def __init__(self, max_workers, initializer, initargs):
+        initializer(*initargs)
+        self.submitted = 0
+        InlineExecutor.last = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, function, chunk):
+        self.submitted += len(chunk)
+        future = concurrent.futures.Future()
+        future.set_result(function(chunk))
+        return future
+
+
+def test_all_pairs_reorder_buffer_is_bounded(rf, monkeypatch):
+    rng = random.Random(5)
+    pool = ["L{}".format(k) for k in range(50)]
+    compact = {k: rf.ReferenceTree(rf.parseNewick(randomTree(rng.sample(pool, rng.randint(5, 40)), rng)))
+               for k in range(25)}
+    pairs = list(itertools.combinations(range(len(compact)), 2))
+    monkeypatch.setattr(rf, "ProcessPoolExecutor", InlineExecutor)
+    args = argparse.Namespace(jobs=2, chunk_size=2, profile=False, profile_memory=False)
+    reported, waiting = [], []
+
+    def report(i, j, result):
+        reported.append((i, j))
+        waiting.append(InlineExecutor.last.submitted - len(reported))
+
+    rf.comparePairs(args, report, ("bfc", False, False, True, False), compact, pairs)
+    assert reported == pairs
+    # two windows of CHUNKS_IN_FLIGHT chunks per job
+    assert max(waiting) < 2 * rf.CHUNKS_IN_FLIGHT * args.jobs * args.chunk_size
+
+
+def test_pair_chunks_sorted_within_window(rf):
+    pairs = [(0, k) for k in range(1, 11)]
+    chunks = rf.pairChunks(pairs, lambda k: k % 4, 4, 5, 2)
+    assert [[k for k, i, j in chunk] for chunk in chunks] == [[7, 6], [5, 4], [8]]
+
+
+@pytest.mark.parametrize("options", [[], ["-j", "2"]])
+def test_profile_traces_memory_only_on_request(runRF, inputfile, options):
+    for flag, traced in [("--profile", False), ("--profile-memory", True)]:
+        lines = [json.loads(line) for line in runRF("-i", inputfile, "-r", flag, *options, stream="stderr").splitlines()]
+        assert lines[-1]["aggregate"] and len(lines) == 8
+        assert all(("peak_memory" in x) == traced for x in lines)
+        assert all("dp" in x["phases"] for x in lines[:-1])
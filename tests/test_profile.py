@@ -0,0 +1,42 @@
+import tracemalloc
+import pytest
+
+
+
+@pytest.fixture
+def traced():
+    tracemalloc.start()
+    yield
+    tracemalloc.stop()
+
+
+def test_phase_peaks(rf, traced):
+    profile = rf.Profile()
+    with profile.phase("outer"):
+        with profile.phase("small"):
+            small = bytearray(1 << 10)
+        with profile.phase("large"):
+            large = bytearray(1 << 24)
+            del large
+        with profile.phase("after"):
+            pass
+    peaks = profile.summary()
+    assert "peak_memory" not in peaks
+    assert profile.peaks["large"] >= profile.peaks["small"] + (1 << 23)
+    # the peak of a phase includes the phases nested in it
+    assert profile.peaks["outer"] >= profile.peaks["large"]
+    assert profile.peaks["after"] < profile.peaks["large"] - (1 << 23)
+    assert profile.tracedPeak() >= profile.peaks["large"]
+
+
+def test_phase_peaks_in_summary(rf, traced):
+    T = rf.parseNewick("((a,b),(c,d));")
+    summary = rf.comparePair(rf.ReferenceTree(T), rf.parseNewick("((a,c),(b,e));"), profile=True).summary
+    assert set(summary["phase_peak_memory"]) <= set(summary["phases"])
+    assert summary["peak_memory"] >= max(summary["phase_peak_memory"].values())
+
+
+def test_untraced_summary(rf):
+    summary = rf.comparePair(rf.parseNewick("((a,b),(c,d));"), rf.parseNewick("((a,c),(b,e));"), profile=True).summary
+    assert "peak_memory" not in summary and "phase_peak_memory" not in summary
+    assert summary["phases"]["dp"] > 0
@@ -0,0 +1,61 @@
+import argparse
+import json
+import random
+import pytest
+from ete3 import Tree
+
+
+
+def randomTree(names, rng):
+    # newick string of a random rooted binary tree over names, joining two random subtrees until one is left
+    subtrees = list(names)
+    while len(subtrees) > 1:
+        i, j = sorted(rng.sample(range(len(subtrees)), 2))
+        joined = "({},{})".format(subtrees[i], subtrees[j])
+        subtrees[j] = subtrees[-1]
+        subtrees.pop()
+        subtrees[i] = joined
+    return subtrees[0] + ";"
+
+
+def randomPair(n, overlap, rng):
+    # two random trees of n leaves, sharing overlap of them
+    shared = ["s{}".format(k) for k in range(overlap)]
+    first = shared + ["a{}".format(k) for k in range(n - overlap)]
+    second = shared + ["b{}".format(k) for k in range(n - overlap)]
+    return randomTree(first, rng), randomTree(second, rng)
+
+
+@pytest.mark.parametrize("unrooted", [False, True])
+@pytest.mark.parametrize("n, overlap", [(4, 4), (8, 3), (20, 20), (30, 12), (60, 45)])
+def test_same_as_ete3(rf, n, overlap, unrooted):
+    rng = random.Random(n * 1000 + overlap)
+    for _ in range(10):
+        x, y = randomPair(n, overlap, rng)
+        expected = Tree(x).robinson_foulds(Tree(y), unrooted_trees=unrooted)[0]
+        assert rf.robinsonFoulds(rf.parseNewick(x), rf.parseNewick(y), unrooted) == expected
+        # ete3 trees are converted to compact trees
+        assert rf.robinsonFoulds(Tree(x), Tree(y), unrooted) == expected
+
+
+def test_disjoint_leaf_sets(rf):
+    x, y = randomPair(10, 0, random.Random(0))
+    assert rf.robinsonFoulds(rf.parseNewick(x), rf.parseNewick(y)) == 0
+
+
+def test_serve_forgets_newick_leaves(rf):
+    rng = random.Random(1)
+    trees = [rf.ReferenceTree(rf.parseNewick(x)) for x in randomPair(20, 10, rng)]
+    args = argparse.Namespace(unrooted=False, extraneousfree=False, rfdistance=True, lca="bfc")
+    rf.serveRequest(trees, args, json.dumps({"trees": [1, 2]}))
+    interned = len(rf.LEAF_INDEX)
+    for k in range(5):
+        # every request brings leaf names never seen before
+        x, y = randomPair(20, 10, rng)
+        request = {"trees": [1, y.replace("b", "new{}_".format(k))]}
+        answer = rf.serveRequest(trees, args, json.dumps(request))
+        assert "error" not in answer
+        assert len(rf.LEAF_INDEX) == interned
+    # the trees of the input file are still compared with their own leaf names
+    assert rf.serveRequest(trees, args, json.dumps({"trees": [1, 2]}))["rf"] == \
+        Tree(trees[0].tree.newick()).robinson_foulds(Tree(trees[1].tree.newick()))[0]
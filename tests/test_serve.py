@@ -0,0 +1,60 @@
+import argparse
+import json
+import pytest
+
+
+
+TREES = ["((a,b),(c,d));", "((a,c),(b,e));", "(((a,b),c),f);"]
+
+
+
+def serveArgs(**options):
+    args = dict(inputfile=None, cache_dir=None, socket=None, unrooted=False, extraneousfree=False, rfdistance=False,
+                lca="bfc")
+    args.update(options)
+    return argparse.Namespace(**args)
+
+
+@pytest.fixture
+def trees(rf):
+    return [rf.ReferenceTree(rf.parseNewick(x)) for x in TREES]
+
+
+def test_request(rf, trees):
+    answer = rf.serveRequest(trees, serveArgs(), json.dumps({"id": 7, "trees": [1, TREES[2]], "completions": False}))
+    assert answer["id"] == 7 and "error" not in answer and "completions" not in answer
+    assert answer["leaves"] == [4, 4] and answer["union"] == 5 and answer["intersection"] == 3
+
+
+@pytest.mark.parametrize("key", ["unrooted", "extraneousfree", "completions"])
+@pytest.mark.parametrize("value", ["false", "true", 0, 1, None])
+def test_flags_must_be_booleans(rf, trees, key, value):
+    answer = rf.serveRequest(trees, serveArgs(), json.dumps({"trees": [1, 2], key: value}))
+    assert answer["error"] == "ValueError: {} must be true or false".format(key)
+
+
+def test_flags(rf, trees):
+    answer = rf.serveRequest(trees, serveArgs(rfdistance=True), json.dumps({"trees": [1, 2], "completions": True}))
+    assert len(answer["completions"]) == 2
+    answer = rf.serveRequest(trees, serveArgs(), json.dumps({"trees": [1, 2], "unrooted": True}))
+    expected = rf.comparePair(trees[0], trees[1], unrooted=True, distanceOnly=True)
+    assert (answer["rf_plus"], answer["ef_rf_plus"]) == expected[3:5]
+
+
+def test_serve_stdin(runRF, tmp_path):
+    path = tmp_path / "trees.newick"
+    path.write_text("\n".join(TREES) + "\n")
+    requests = [{"id": 1, "trees": [1, 2]}, {"id": 2, "trees": [1, 3], "unrooted": "false"}]
+    answers = [json.loads(line) for line in
+               runRF("-i", path, "-r", "--serve", input="".join(json.dumps(x) + "\n" for x in requests)).splitlines()]
+    assert [x["id"] for x in answers] == [1, 2]
+    assert "rf" in answers[0] and "error" in answers[1]
+
+
+def test_socket_path_not_a_socket(rf, tmp_path, capsys):
+    path, victim = tmp_path / "trees.newick", tmp_path / "victim.txt"
+    path.write_text("\n".join(TREES) + "\n")
+    victim.write_text("keep me")
+    rf.serve(serveArgs(inputfile=str(path), socket=str(victim)))
+    assert victim.read_text() == "keep me"
+    assert "not a socket" in capsys.readouterr().out
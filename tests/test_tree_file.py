@@ -0,0 +1,52 @@
+import gzip
+import os
+import subprocess
+import pytest
+
+
+
+TREES = ["((a,b),(c,d));", "((a,c),(b,e));", "", "(((a,b),c),f);", "((b,d),(a,f));"]
+
+
+
+@pytest.fixture
+def inputfile(tmp_path):
+    path = tmp_path / "trees.newick"
+    path.write_text("\n".join(TREES) + "\n")
+    return path
+
+
+def test_index_without_selection_writes_sidecar(runRF, inputfile):
+    expected = runRF("-i", inputfile, "-r")
+    assert runRF("-i", inputfile, "-r", "--index") == expected
+    assert os.path.exists(str(inputfile) + ".rfidx")
+    # the next run reads the positions of the trees from the sidecar file
+    assert runRF("-i", inputfile, "-r", "--index") == expected
+    assert runRF("-i", inputfile, "-r", "--all-pairs", "--index") == runRF("-i", inputfile, "-r", "--all-pairs")
+
+
+def test_index_matches_scan(rf, inputfile):
+    scanned = rf.TreeFile(str(inputfile), save=True)
+    indexed = rf.TreeFile(str(inputfile))
+    assert scanned.count == indexed.count == 4
+    assert scanned.starts.tolist() == indexed.starts.tolist() and scanned.ends.tolist() == indexed.ends.tolist()
+    assert [T.newick() for k, T in indexed.trees([1, 3])] == [T.newick() for k, T in scanned.trees([1, 3])]
+
+
+def test_compressed_input(rf, tmp_path):
+    path = tmp_path / "trees.newick.gz"
+    with gzip.open(path, "wt") as f:
+        f.write("\n".join(TREES) + "\n")
+    source = rf.TreeFile(str(path))
+    assert source.count == 4
+    assert [k for k, T in source.trees([0, 2])] == [0, 2]
+
+
+def test_index_refuses_compressed_input(runRF, tmp_path):
+    path = tmp_path / "trees.newick.gz"
+    with gzip.open(path, "wt") as f:
+        f.write("\n".join(TREES) + "\n")
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        runRF("-i", path, "-r", "--index")
+    assert "--index cannot be used with a compressed input file" in error.value.stderr
+    assert not os.path.exists(str(path) + ".rfidx")